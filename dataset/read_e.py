@@ -15,6 +15,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from src.filepath import ABSOLUTE_PATH
 
 sys.path.append(ABSOLUTE_PATH)
+from src.inference.interface import nearest_nodes
 
 
 def unique_within_tolerance(arr, tol):
@@ -282,17 +283,14 @@ def read_e(flux, bc, path, tolerance=1e-4, decimals=10):
 
             # coord_to_phy = {tuple(coord): z for coord, z in zip(coords_prime, phy)}
 
-            phy_sorted = np.empty_like(phy)
-
-            for i, (x_val, y_val) in enumerate(zip(x_base, y_base)):
-                distances = np.sqrt((x_tran - x_val) ** 2 + (y_tran - y_val) ** 2)
-
-                min_distance_index = np.argmin(distances)
-                phy_sorted[i] = phy[min_distance_index]
-                if distances[min_distance_index] > tolerance:
-                    print(
-                        f"Multiple matching coordinates found for ({block_id},{x_val}, {y_val}) within tolerance, the min distance is {distances[min_distance_index]}."
-                    )
+            distances, min_distance_index = nearest_nodes(
+                np.stack((x_tran, y_tran), axis=-1), np.stack((x_base, y_base), axis=-1)
+            )
+            phy_sorted = phy[min_distance_index]
+            for i in np.nonzero(distances > tolerance)[0]:
+                print(
+                    f"Multiple matching coordinates found for ({block_id},{x_base[i]}, {y_base[i]}) within tolerance, the min distance is {distances[i]}."
+                )
         all_phy.append(phy_sorted)
     neighbors = {
         1: ("left", "right", 11),
@@ -0,0 +1,162 @@
+import copy
+import torch
+
+
+class CompiledAdjacency(object):
+    """element adjacency compiled to gather indices, used in place of the adj dict in multi element composition.
+
+    The adj dict maps each element (1-based) to its neighbors, e.g. {1: ("sym", "free", 11), ...}, where an int is
+    a neighboring element and anything else is a boundary type passed to boundary_emb. It is compiled once to
+        neighbor_index: n_element, n_slot, 0-based index of the neighbor in each slot (0 for boundary slots)
+        boundary_mask: n_element, n_slot, True for boundary slots
+        boundary_value: n_b, n_element, n_slot, n_node, c, boundary embedding of boundary slots
+    so that the condition of all elements is assembled with one index_select and one torch.where per step.
+    Fields of several scenarios stacked scenario major (n_scenario * n_element, ...) are gathered per scenario.
+    """
+
+    def __init__(self, adj, boundary_emb, device="cuda"):
+        """
+        Args:
+            adj (dict): neighbor for each element.
+            boundary_emb: emb function for boundary, returns an array of shape n_node, c. A list of emb functions
+                gives a different boundary condition for each scenario.
+            device (str, optional): Defaults to 'cuda'.
+        """
+        n_element = len(adj)
+        n_slot = len(adj[1])
+        boundary_emb_list = boundary_emb if isinstance(boundary_emb, (list, tuple)) else [boundary_emb]
+        neighbor_index = torch.zeros((n_element, n_slot), dtype=torch.long)
+        boundary_mask = torch.zeros((n_element, n_slot), dtype=torch.bool)
+        boundary_value = None
+        for i in range(n_element):
+            for j, neighbor in enumerate(adj[i + 1]):
+                if isinstance(neighbor, int):
+                    neighbor_index[i, j] = neighbor - 1
+                    continue
+                boundary_mask[i, j] = True
+                for b, emb in enumerate(boundary_emb_list):
+                    b_emb = torch.tensor(emb(neighbor)).float()
+                    if boundary_value is None:
+                        boundary_value = torch.zeros((len(boundary_emb_list), n_element, n_slot) + tuple(b_emb.shape))
+                    boundary_value[b, i, j] = b_emb
+        self.adj = adj
+        self.neighbor_index = neighbor_index.to(device)
+        self.boundary_mask = boundary_mask.to(device)
+        self.boundary_value = boundary_value.to(device) if boundary_value is not None else None
+        # number of elements of the field gathered from, differs from len(self) for a subset
+        self.n_source = n_element
+        # gather index of a batch of scenarios, keyed by n_scenario
+        self.scenario_index = {1: self.neighbor_index.reshape(-1)}
+        self.colors = None
+
+    def __len__(self):
+        return self.neighbor_index.shape[0]
+
+    @property
+    def n_slot(self):
+        return self.neighbor_index.shape[1]
+
+    def subset(self, elements):
+        """adjacency of a subset of elements (0-based index tensor), still gathering from the field of all elements"""
+        sub = copy.copy(self)
+        elements = elements.to(self.neighbor_index.device)
+        sub.neighbor_index = self.neighbor_index[elements]
+        sub.boundary_mask = self.boundary_mask[elements]
+        sub.boundary_value = self.boundary_value[:, elements] if self.boundary_value is not None else None
+        sub.scenario_index = {1: sub.neighbor_index.reshape(-1)}
+        sub.colors = None
+        return sub
+
+    def scenarios(self, index):
+        """adjacency of the scenarios index (0-based index tensor) of a batch of scenarios, gathering from the field of
+        these scenarios only with their boundary conditions"""
+        sub = copy.copy(self)
+        if self.boundary_value is not None and self.boundary_value.shape[0] > 1:
+            sub.boundary_value = self.boundary_value[index.to(self.boundary_value.device)]
+        return sub
+
+    def restrict(self, elements, sources):
+        """adjacency of a subset of elements gathering from the field of the elements sources only, e.g. the elements
+        of one process and their halo
+
+        Args:
+            elements (Tensor): 0-based index of the elements.
+            sources (Tensor): 0-based index of the elements of the field gathered from, with every neighbor of elements.
+        Returns:
+            CompiledAdjacency: gathers from a field of shape: n_scenario * len(sources), n_node, c
+        """
+        sub = self.subset(elements)
+        sources = sources.to(self.neighbor_index.device)
+        position = torch.full((self.n_source,), -1, dtype=torch.long, device=sources.device)
+        position[sources] = torch.arange(len(sources), device=sources.device)
+        neighbor_index = torch.where(sub.boundary_mask, 0, position[sub.neighbor_index])
+        assert (neighbor_index >= 0).all(), "a neighbor of elements is not in sources"
+        sub.neighbor_index = neighbor_index
+        sub.n_source = len(sources)
+        sub.scenario_index = {1: neighbor_index.reshape(-1)}
+        return sub
+
+    def color_classes(self):
+        """greedy colouring of the element graph, largest degree first, so that no two neighboring elements share a
+        colour. Elements of one colour class only depend on elements of other classes.
+
+        Returns:
+            list: 0-based element index tensor of each colour class
+        """
+        if self.colors is None:
+            n_element = len(self)
+            neighbor_index, boundary_mask = self.neighbor_index.cpu(), self.boundary_mask.cpu()
+            graph = [set() for _ in range(n_element)]
+            for i in range(n_element):
+                for j in neighbor_index[i][~boundary_mask[i]].tolist():
+                    if j != i:
+                        graph[i].add(j)
+                        graph[j].add(i)
+            color = [-1] * n_element
+            for i in sorted(range(n_element), key=lambda e: -len(graph[e])):
+                used = {color[j] for j in graph[i]}
+                color[i] = next(c for c in range(n_element) if c not in used)
+            color = torch.tensor(color)
+            self.colors = [torch.nonzero(color == c).reshape(-1) for c in range(int(color.max()) + 1)]
+        return self.colors
+
+    def index(self, n_scenario=1):
+        """flat gather index of n_scenario scenarios stacked scenario major"""
+        if n_scenario not in self.scenario_index:
+            offset = self.n_source * torch.arange(n_scenario, device=self.neighbor_index.device)
+            self.scenario_index[n_scenario] = (self.neighbor_index[None] + offset[:, None, None]).reshape(-1)
+        return self.scenario_index[n_scenario]
+
+    def gather(self, field):
+        """neighbor field of each element, with boundary embedding in boundary slots
+
+        Args:
+            field (Tensor): field of each element, shape: n_scenario * n_source, n_node, c
+        Returns:
+            Tensor: shape: n_scenario * n_element, n_node, n_slot * c, slot j is in channel j * c : (j + 1) * c
+        """
+        n_element, n_slot = self.neighbor_index.shape
+        n_scenario = field.shape[0] // self.n_source
+        neighbor = field.index_select(0, self.index(n_scenario))
+        neighbor = neighbor.reshape((n_scenario, n_element, n_slot) + tuple(field.shape[1:]))
+        if self.boundary_value is not None:
+            neighbor = torch.where(self.boundary_mask[None, :, :, None, None], self.boundary_value, neighbor)
+        return neighbor.transpose(2, 3).reshape(n_scenario * n_element, field.shape[1], -1)
+
+    def assemble(self, field, extra=None):
+        """condition of each element: neighbor field followed by element-wise condition such as flux
+
+        Args:
+            field (Tensor): field of each element, shape: n_scenario * n_source, n_node, c
+            extra (Tensor, optional): element-wise condition, shape: n_scenario * n_element, * or
+                n_scenario * n_element, n_node, k
+        Returns:
+            Tensor: shape: n_scenario * n_element, n_node, n_slot * c + k
+        """
+        node_feature = self.gather(field)
+        if extra is None:
+            return node_feature
+        n_batch, n_node = node_feature.shape[0], node_feature.shape[1]
+        if extra.dim() < 3:
+            extra = extra.reshape(n_batch, 1, -1).expand(-1, n_node, -1)
+        return torch.concat((node_feature, extra.to(node_feature.dtype)), dim=-1)
@@ -1,9 +1,401 @@
+import os
+import json
+import time
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
 import torch
 from tqdm.auto import tqdm
 from torch import nn
 
 
-def compose_diffusion(
+# estimate yielded by the compose streams, step is None after an outer iteration,
+# index is the index of the samples in estimate (None for all samples)
+ComposeState = namedtuple("ComposeState", ["k", "step", "estimate", "index"])
+
+
+def run_stream(stream):
+    """run a compose stream to the end and return its result"""
+    while True:
+        try:
+            next(stream)
+        except StopIteration as stop:
+            return stop.value
+
+
+def relative_change(estimate, estimate_before):
+    """relative L2 change of each sample between two outer iterations, as in moose/ntc/decouple/run_couple.py
+
+    Args:
+        estimate (Tensor): estimate of current outer iteration, shape: b, *
+        estimate_before (Tensor): estimate of previous outer iteration, shape: b, *
+    Returns:
+        Tensor: relative change of each sample, shape: b
+    """
+    b = estimate.shape[0]
+    diff = (estimate - estimate_before).reshape(b, -1).norm(dim=1)
+    return diff / estimate.reshape(b, -1).norm(dim=1).clamp(min=1e-12)
+
+
+def converged_mask(mult_p_estimate, mult_p_estimate_before, tol):
+    """samples whose estimates of all fields changed less than tol in the last outer iteration
+
+    Args:
+        mult_p_estimate (list): estimate of each physics field in current outer iteration.
+        mult_p_estimate_before (list): estimate of each physics field in previous outer iteration.
+        tol (float): tolerance of relative L2 change.
+    Returns:
+        Tensor: bool mask of converged samples, shape: b
+    """
+    change = [relative_change(e, e_b) for e, e_b in zip(mult_p_estimate, mult_p_estimate_before)]
+    return torch.stack(change).amax(dim=0) < tol
+
+
+def noise_to(model, x_start, t, noise=None):
+    """diffuse x_start to timestep t with q(x_t | x_0), used to warm restart an outer iteration"""
+    time = torch.full((x_start.shape[0],), t, device=x_start.device, dtype=torch.long)
+    return model.q_sample(x_start, time, noise=noise)
+
+
+def is_surrogate(model):
+    """a field model predicting the field from its condition in one forward (--paradigm surrogate), not a diffusion"""
+    return not hasattr(model, "num_timesteps")
+
+
+def surrogate_due(step, n_step, surrogate_every):
+    """a surrogate field is evaluated every surrogate_every steps from the first and at the last step of each outer
+    iteration, only at the last step if surrogate_every is None
+    """
+    return step + 1 == n_step or (surrogate_every is not None and step % surrogate_every == 0)
+
+
+def field_due(step, n_step, every):
+    """a diffusion field with update period every is denoised at every every-th step and at the last step"""
+    return every is None or step % every == 0 or step + 1 == n_step
+
+
+class Snapshot(object):
+    """snapshot of composition state on disk, taken at most every `every` seconds of wall-clock time.
+
+    The state includes the cpu and cuda RNG states, so a composition resumed from it continues bit-identically.
+    """
+
+    def __init__(self, path, every=600):
+        """
+        Args:
+            path (str): snapshot file.
+            every (float, optional): seconds between two snapshots. Defaults to 600.
+        """
+        self.path = str(path)
+        self.every = every
+        self.last = time.time()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def due(self):
+        return time.time() - self.last >= self.every
+
+    def save(self, state):
+        state = dict(state)
+        state["rng"] = torch.get_rng_state()
+        state["cuda_rng"] = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+        # write to a temporary file first, so an interruption never leaves a broken snapshot
+        torch.save(state, self.path + ".tmp")
+        os.replace(self.path + ".tmp", self.path)
+        self.last = time.time()
+
+    def load(self):
+        state = torch.load(self.path, map_location="cpu")
+        torch.set_rng_state(state["rng"])
+        if state["cuda_rng"] is not None:
+            torch.cuda.set_rng_state_all(state["cuda_rng"])
+        return state
+
+
+class Anderson(object):
+    """Anderson acceleration of the outer iteration, seen as a fixed-point iteration x <- G(x) on the estimates, where
+    x is the estimate before an outer iteration and G(x) the estimate after it. The estimate the next outer iteration
+    starts from is extrapolated from the last m + 1 outer iterations, m = 1 is a secant (Aitken like) step.
+    """
+
+    def __init__(self, m=3, reg=1e-8):
+        """
+        Args:
+            m (int, optional): number of previous outer iterations mixed. Defaults to 3.
+            reg (float, optional): relative Tikhonov regularization of the least squares. Defaults to 1e-8.
+        """
+        self.m = m
+        self.reg = reg
+        self.reset()
+
+    def reset(self):
+        self.x, self.g = [], []
+
+    def __call__(self, x, g):
+        """
+        Args:
+            x (Tensor or list): estimate (of each field) before the outer iteration, shape: b, *
+            g (Tensor or list): estimate (of each field) after the outer iteration, shape: b, *
+        Returns:
+            Tensor or list: extrapolated estimate, same as g
+        """
+        fields = isinstance(g, (list, tuple))
+        x, g = (x, g) if fields else ([x], [g])
+        b = g[0].shape[0]
+        self.x.append(torch.concat([e.reshape(b, -1) for e in x], dim=1))
+        self.g.append(torch.concat([e.reshape(b, -1) for e in g], dim=1))
+        self.x, self.g = self.x[-self.m - 1 :], self.g[-self.m - 1 :]
+        if len(self.g) == 1:
+            return g if fields else g[0]
+        f = torch.stack([g_i - x_i for x_i, g_i in zip(self.x, self.g)], dim=-1)  # b, n, m + 1
+        df = f[..., 1:] - f[..., :-1]
+        dg = torch.stack(self.g, dim=-1)
+        dg = dg[..., 1:] - dg[..., :-1]
+        # gamma minimizes |f_k - df gamma| for each sample
+        a = df.transpose(1, 2) @ df
+        eps = self.reg * a.diagonal(dim1=1, dim2=2).sum(-1).clamp(min=1e-12)
+        a = a + eps[:, None, None] * torch.eye(a.shape[-1], device=a.device, dtype=a.dtype)
+        gamma = torch.linalg.solve(a, df.transpose(1, 2) @ f[..., -1:])
+        out = self.g[-1] - (dg @ gamma)[..., 0]
+        out = [o.reshape(e.shape) for o, e in zip(out.split([e[0].numel() for e in g], dim=1), g)]
+        return out if fields else out[0]
+
+    def keep(self, mask):
+        """keep the history of the samples in mask"""
+        self.x = [x[mask] for x in self.x]
+        self.g = [g[mask] for g in self.g]
+
+
+class Telemetry(object):
+    """timeline of a composition: time spans of condition assembly and of the denoiser of each field (or batch of
+    elements) at each step, and after each outer iteration the relative change of the estimate of each sample (each
+    element in multi element composition). Saved as JSON, or as a Chrome trace opened in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self, synchronize=True):
+        """
+        Args:
+            synchronize (bool, optional): synchronize cuda at the ends of a span, so it times the kernels launched in
+                it rather than their launch. Defaults to True.
+        """
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.start = time.perf_counter()
+        self.spans = []
+        self.iterations = []
+
+    def now(self):
+        """seconds since the telemetry was created"""
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter() - self.start
+
+    @contextmanager
+    def span(self, name, **args):
+        begin = self.now()
+        try:
+            yield
+        finally:
+            self.spans.append({"name": name, "begin": begin, "end": self.now(), "args": args})
+
+    def outer(self, k, begin, estimate, estimate_before, index=None):
+        """record outer iteration k, started at begin, from the estimates of each field after and before it"""
+        change = [relative_change(e, e_b).tolist() for e, e_b in zip(estimate, estimate_before)]
+        self.iterations.append(
+            {
+                "k": k,
+                "begin": begin,
+                "end": self.now(),
+                "residual": max(max(c) for c in change),
+                "change": change,
+                "index": index.tolist() if index is not None else None,
+            }
+        )
+
+    def summary(self):
+        """total seconds and count of the spans of each name (and field)"""
+        total = {}
+        for span in self.spans:
+            key = span["name"] + ("/" + str(span["args"]["field"]) if "field" in span["args"] else "")
+            seconds, count = total.get(key, (0.0, 0))
+            total[key] = (seconds + span["end"] - span["begin"], count + 1)
+        return {key: {"seconds": seconds, "count": count} for key, (seconds, count) in total.items()}
+
+    def save_json(self, path):
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "spans": self.spans, "iterations": self.iterations}, f)
+
+    def save_chrome_trace(self, path):
+        """Chrome trace event format: outer iterations and spans as complete events (in microseconds), one thread
+        per field (or batch of elements), and the residual as a counter
+        """
+        events = []
+        for it in self.iterations:
+            events.append(
+                {
+                    "name": "outer iteration " + str(it["k"]),
+                    "cat": "outer",
+                    "ph": "X",
+                    "ts": it["begin"] * 1e6,
+                    "dur": (it["end"] - it["begin"]) * 1e6,
+                    "pid": 0,
+                    "tid": 0,
+                    "args": {"residual": it["residual"]},
+                }
+            )
+            events.append(
+                {"name": "residual", "ph": "C", "ts": it["end"] * 1e6, "pid": 0, "args": {"residual": it["residual"]}}
+            )
+        for span in self.spans:
+            events.append(
+                {
+                    "name": span["name"],
+                    "cat": "step",
+                    "ph": "X",
+                    "ts": span["begin"] * 1e6,
+                    "dur": (span["end"] - span["begin"]) * 1e6,
+                    "pid": 0,
+                    "tid": span["args"].get("field", span["args"].get("batch", 0)) + 1,
+                    "args": span["args"],
+                }
+            )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def telemetry_span(telemetry, name, **args):
+    """span of telemetry, nothing if telemetry is None"""
+    return nullcontext() if telemetry is None else telemetry.span(name, **args)
+
+
+def slice_condition(cond, sl, batch):
+    """slice the batch dimension of tensors in a (nested list / tuple of) condition"""
+    if isinstance(cond, torch.Tensor):
+        return cond[sl] if cond.dim() > 0 and cond.shape[0] == batch else cond
+    if isinstance(cond, (list, tuple)):
+        return type(cond)(slice_condition(c, sl, batch) for c in cond)
+    return cond
+
+
+def condition_tensors(cond, batch):
+    """batch first tensors in a (nested list / tuple of) condition"""
+    if isinstance(cond, torch.Tensor):
+        return [cond] if cond.dim() > 0 and cond.shape[0] == batch else []
+    if isinstance(cond, (list, tuple)):
+        return [t for c in cond for t in condition_tensors(c, batch)]
+    return []
+
+
+def dedup_index(batch, *tensors):
+    """identical rows over batch first tensors, found by hashing each row with a fixed random projection
+
+    Returns:
+        Tensor: index of one representative row of each unique row, shape: n_unique
+        Tensor: index of each row in the unique rows, shape: batch
+    """
+    rows = [t.reshape(batch, -1).double() for t in tensors]
+    if len(rows) == 0:
+        return torch.zeros(1, dtype=torch.long), torch.zeros(batch, dtype=torch.long)
+    rows = torch.concat(rows, dim=1)
+    generator = torch.Generator(device=rows.device).manual_seed(0)
+    key = rows @ torch.randn(rows.shape[1], 2, generator=generator, device=rows.device, dtype=rows.dtype)
+    _, inverse = torch.unique(key, dim=0, return_inverse=True)
+    n_unique = int(inverse.max()) + 1
+    first = torch.full((n_unique,), batch, device=rows.device, dtype=torch.long)
+    first = first.scatter_reduce(0, inverse, torch.arange(batch, device=rows.device), reduce="amin")
+    return first, inverse
+
+
+def randn_rows(batch, shape, device, shared=None):
+    """standard normal field of batch rows, rows with the same shared index (from dedup_index) are equal"""
+    if shared is None:
+        return torch.randn((batch,) + tuple(shape)).to(device)
+    return torch.randn((int(shared.max()) + 1,) + tuple(shape)).to(device)[shared.to(device)]
+
+
+def probe_chunk_size(model, x, time_cond, cond, memory_budget):
+    """number of samples per forward fitting in memory_budget (GB), from the peak memory of a forward of one sample"""
+    if not x.is_cuda:
+        return x.shape[0]
+    torch.cuda.synchronize(x.device)
+    torch.cuda.reset_peak_memory_stats(x.device)
+    base = torch.cuda.memory_allocated(x.device)
+    model.model_predictions(x[:1], time_cond[:1], slice_condition(cond, slice(0, 1), x.shape[0]))
+    per_sample = max(torch.cuda.max_memory_allocated(x.device) - base, 1)
+    return max(1, min(x.shape[0], int(memory_budget * 1024**3 // per_sample)))
+
+
+def model_predictions_chunked(model, x, time_cond, cond, chunk_size, clip_x_start=False):
+    """model.model_predictions evaluated chunk_size samples at a time, written into buffers of the whole batch"""
+    batch = x.shape[0]
+    pred_noise, x_start = torch.empty_like(x), torch.empty_like(x)
+    for start in range(0, batch, chunk_size):
+        sl = slice(start, start + chunk_size)
+        pred_noise[sl], x_start[sl], *_ = model.model_predictions(
+            x[sl], time_cond[sl], slice_condition(cond, sl, batch), x_self_cond=None, clip_x_start=clip_x_start
+        )
+    return pred_noise, x_start
+
+
+def p_sample_chunked(model, x, t: int, cond, chunk_size, clip_denoised=True):
+    """model.p_sample with the denoiser evaluated chunk_size samples at a time.
+
+    The noise is drawn for the whole batch, so the result is that of model.p_sample up to the rounding of kernels
+    on smaller batches.
+    """
+    batched_times = torch.full((x.shape[0],), t, device=x.device, dtype=torch.long)
+    _, x_start = model_predictions_chunked(model, x, batched_times, cond, chunk_size)
+    if clip_denoised:
+        x_start.clamp_(model.clip_bound[0], model.clip_bound[1])
+    model_mean, _, model_log_variance = model.q_posterior(x_start=x_start, x_t=x, t=batched_times)
+    noise = model.randn(x.shape, x.device) if t > 0 else 0.0  # no noise if t == 0
+    return model_mean + (0.5 * model_log_variance).exp() * noise, x_start
+
+
+def sweep_classes(adj, n_scenario, gauss_seidel, frozen=None, done=None):
+    """batches of elements denoised one after another in each step of multi element composition: the whole assembly
+    at once (Jacobi), or each colour class of adj in turn, conditioned on the freshest estimates of the other classes
+    (Gauss-Seidel). Frozen elements and the scenarios in done are left out of every batch.
+
+    Returns:
+        list: (adjacency, flat index of the batch or None for the whole assembly) of each batch
+    """
+    if not gauss_seidel and (frozen is None or not frozen.any()) and (done is None or not done.any()):
+        return [(adj, None)]
+    scenarios = torch.arange(n_scenario or 1) if done is None else torch.nonzero(~done.cpu()).reshape(-1)
+    offset = len(adj) * scenarios
+    sweep = []
+    for elements in adj.color_classes() if gauss_seidel else [torch.arange(len(adj))]:
+        if frozen is not None:
+            elements = elements[~frozen.cpu()[elements]]
+            if len(elements) == 0:
+                continue
+        index = (elements[None] + offset[:, None]).reshape(-1).to(adj.neighbor_index.device)
+        adj_c = adj.subset(elements)
+        sweep.append((adj_c if done is None else adj_c.scenarios(scenarios), index))
+    return sweep
+
+
+def scenario_rows(done, n_compose, device):
+    """flat index of the rows of the scenarios not in done, None if no scenario is done"""
+    if done is None or not done.any():
+        return None
+    scenarios = torch.nonzero(~done.cpu()).reshape(-1)
+    return (n_compose * scenarios[:, None] + torch.arange(n_compose)[None]).reshape(-1).to(device)
+
+
+def kept_rows(frozen, done, n_compose, n_scenario):
+    """bool mask of the rows that keep their result: frozen elements in every scenario and every element of the
+    scenarios in done, None if there are none"""
+    keep = None
+    if frozen is not None and frozen.any():
+        keep = frozen.repeat(n_scenario or 1)
+    if done is not None and done.any():
+        keep = done.repeat_interleave(n_compose) | (keep if keep is not None else False)
+    return keep
+
+
+@torch.no_grad()
+def compose_diffusion_stream(
     model_list,
     shape: list,
     update_f: list,
@@ -12,11 +404,20 @@ def compose_diffusion(
     other_condition=[],
     num_iter=2,
     device="cuda",
+    tol=None,
+    restart_t=None,
+    snapshot=None,
+    resume=False,
+    yield_every=None,
+    surrogate_every=1,
+    anderson=None,
+    telemetry=None,
 ):
-    """compose diffusion model
+    """compose diffusion model, yielding the estimates while composing
 
     Args:
-        model_list (_type_):conditional diffusion model for each physics field
+        model_list (_type_):conditional diffusion model for each physics field, or a surrogate model (called as
+            model(cond) and returning the field) for fields that need no generative modeling
         shape (_type_): shape of field: b, c, *
         update_f (list): update function for each physics field
         normalize_f (_type_, optional): normalization function for each physics field.
@@ -24,33 +425,92 @@ def compose_diffusion(
         other_condition (list): other_condition such as initial state, source term.
         num_iter: (int, optional): outer iteration. Defaults to 2.
         device (str, optional): _description_. Defaults to 'cuda'.
+        tol (float, optional): a sample stops the outer iteration once the relative L2 change of all its field
+            estimates between two outer iterations is below tol, and is removed from the batch. Tensors in
+            other_condition must be batch first. Defaults to None, i.e. run num_iter outer iterations.
+        restart_t (int, optional): in outer iterations k > 0, noise the result of the previous outer iteration to
+            timestep restart_t and denoise from there instead of from pure noise at t = T. Defaults to None.
+        snapshot (Snapshot, optional): periodically save the composition state (fields, estimates, RNG state, outer
+            iteration and step) to snapshot.path. Defaults to None.
+        resume (bool, optional): resume from snapshot if its file exists. Defaults to False.
+        yield_every (int, optional): also yield the estimates every yield_every steps. Defaults to None.
+        surrogate_every (int, optional): surrogate fields are evaluated every surrogate_every steps from the first
+            step and at the last step of each outer iteration, their estimate is held in between. None evaluates them
+            at the last step only, the cheapest, but the other fields are then conditioned on noise for them
+            throughout the first outer iteration. Defaults to 1, i.e. every step, which costs as many forwards of
+            the surrogate as of a diffusion field; with surrogate_every = p it takes about 1 / p of them.
+        anderson (Anderson, optional): extrapolate the estimate each outer iteration k > 0 starts from with Anderson
+            acceleration of the previous outer iterations. Defaults to None, i.e. plain iteration.
+        telemetry (Telemetry, optional): record the time of condition assembly and denoiser of each field at each
+            step, and the relative change of each sample after each outer iteration. Defaults to None.
+    Yields:
+        ComposeState: outer iteration, step (None after an outer iteration) and the unnormalized estimates.
     Returns:
         list: a list contains each field
     """
-    with torch.no_grad():
-
-        n_compose = len(model_list)
+    n_compose = len(model_list)
+    surrogate = [is_surrogate(model) for model in model_list]
 
-        timestep = model_list[0].num_timesteps
+    timestep = next(model for model in model_list if not is_surrogate(model)).num_timesteps
 
-        # initial field
-        mult_p_estimate = []
-        for s in shape:
-            mult_p_estimate.append(torch.randn(s, device=device))
+    # initial field
+    mult_p_estimate = []
+    for s in shape:
+        mult_p_estimate.append(torch.randn(s, device=device))
+    # samples still iterating and their index in the output
+    index = torch.arange(shape[0][0], device=device)
+    mult_p_out = [torch.zeros(s, device=device) for s in shape]
+    k_start, step_start = 0, 0
+    if anderson is not None:
+        anderson.reset()
+    if resume and snapshot is not None and snapshot.exists():
+        state = snapshot.load()
+        k_start, step_start = state["k"], state["step"]
+        mult_p, mult_p_estimate, mult_p_estimate_before, mult_p_out = [
+            [x.to(device) for x in state[key]]
+            for key in ["mult_p", "mult_p_estimate", "mult_p_estimate_before", "mult_p_out"]
+        ]
+        index = state["index"].to(device)
+        if anderson is not None:
+            anderson.x, anderson.g = [[x.to(device) for x in history] for history in state["anderson"]]
+        if len(index) < shape[0][0]:
+            other_condition = [c[index] for c in other_condition]
 
-        for k in range(num_iter):
+    for k in range(k_start, num_iter):
+        begin = telemetry.now() if telemetry is not None else None
+        if k > k_start or step_start == 0:
             mult_p_estimate_before = mult_p_estimate.copy()
+        if k == k_start and step_start > 0:
+            pass  # restored from snapshot
+        elif k > 0 and restart_t is not None:
+            # warm restart from the result of previous outer iteration
+            mult_p_estimate = [e.clone() for e in mult_p_estimate_before]
+            mult_p = [
+                mult_p[i] if surrogate[i] else noise_to(model_list[i], mult_p[i], restart_t) for i in range(n_compose)
+            ]
+        else:
             mult_p_estimate = []
             mult_p = []
             for s in shape:
+                s = (len(index),) + tuple(s[1:])
                 mult_p_estimate.append(torch.randn(s, device=device))
                 mult_p.append(torch.randn(s, device=device))
-            for t in tqdm(reversed(range(0, timestep)), desc="sampling loop time step", total=timestep):
-                alpha = 1 - t / (timestep - 1) if k > 0 else 1
+            if k > 0:
+                # surrogate fields keep their estimate until they are evaluated again
                 for i in range(n_compose):
-                    # condition
-                    model = model_list[i]
-                    update = update_f[i]
+                    if surrogate[i]:
+                        mult_p_estimate[i] = mult_p_estimate_before[i].clone()
+        steps = list(reversed(range(0, restart_t + 1 if k > 0 and restart_t is not None else timestep)))
+        for step in tqdm(range(step_start if k == k_start else 0, len(steps)), desc="sampling loop time step"):
+            t = steps[step]
+            alpha = 1 - t / (timestep - 1) if k > 0 else 1
+            for i in range(n_compose):
+                if surrogate[i] and not surrogate_due(step, len(steps), surrogate_every):
+                    continue
+                # condition
+                model = model_list[i]
+                update = update_f[i]
+                with telemetry_span(telemetry, "condition", field=i, k=k, step=step):
                     cond = update(
                         alpha,
                         mult_p_estimate.copy(),
@@ -59,14 +519,63 @@ def compose_diffusion(
                         normalize_f,
                         unnormalize_f,
                     )
+                if surrogate[i]:
+                    with telemetry_span(telemetry, "denoise", field=i, k=k, step=step):
+                        mult_p[i] = model(cond)
+                    mult_p_estimate[i] = mult_p[i]
+                    continue
+                with telemetry_span(telemetry, "denoise", field=i, k=k, step=step):
                     mult_p[i], x0 = model.p_sample(mult_p[i].clone(), t, cond)
-                    # update estimated physics field
+                # update estimated physics field
 
-                    mult_p_estimate[i] = model.unnormalize(x0)
-    return mult_p
+                mult_p_estimate[i] = model.unnormalize(x0)
+            if snapshot is not None and snapshot.due():
+                snapshot.save(
+                    {
+                        "k": k,
+                        "step": step + 1,
+                        "mult_p": mult_p,
+                        "mult_p_estimate": mult_p_estimate,
+                        "mult_p_estimate_before": mult_p_estimate_before,
+                        "mult_p_out": mult_p_out,
+                        "index": index,
+                        "anderson": (anderson.x, anderson.g) if anderson is not None else None,
+                    }
+                )
+            if yield_every is not None and (step + 1) % yield_every == 0:
+                yield ComposeState(k, step + 1, list(mult_p_estimate), index)
+        for i in range(n_compose):
+            mult_p_out[i][index] = mult_p[i]
+        if telemetry is not None:
+            telemetry.outer(k, begin, mult_p_estimate, mult_p_estimate_before, index)
+        yield ComposeState(k, None, list(mult_p_estimate), index)
+        if tol is not None and k > 0:
+            converged = converged_mask(mult_p_estimate, mult_p_estimate_before, tol)
+            if converged.all():
+                break
+        if anderson is not None and k > 0:
+            mult_p_estimate = anderson(mult_p_estimate_before, mult_p_estimate)
+        if tol is not None and k > 0:
+            index = index[~converged]
+            mult_p = [p[~converged] for p in mult_p]
+            mult_p_estimate = [e[~converged] for e in mult_p_estimate]
+            other_condition = [c[~converged] for c in other_condition]
+            if anderson is not None:
+                anderson.keep(~converged)
+    return mult_p_out
 
 
-def compose_diffusion_ddim(
+def compose_diffusion(*args, **kwargs):
+    """compose diffusion model, see compose_diffusion_stream for the arguments
+
+    Returns:
+        list: a list contains each field
+    """
+    return run_stream(compose_diffusion_stream(*args, **kwargs))
+
+
+@torch.no_grad()
+def compose_diffusion_ddim_stream(
     model_list,
     shape: list,
     update_f: list,
@@ -76,11 +585,21 @@ def compose_diffusion_ddim(
     num_iter=2,
     device="cuda",
     clip_denoised=True,
+    tol=None,
+    restart_t=None,
+    snapshot=None,
+    resume=False,
+    yield_every=None,
+    surrogate_every=1,
+    update_every=None,
+    anderson=None,
+    telemetry=None,
 ):
-    """compose diffusion model
+    """compose diffusion model, yielding the estimates while composing
 
     Args:
-        model_list (_type_):conditional diffusion model for each physics field
+        model_list (_type_):conditional diffusion model for each physics field, or a surrogate model (called as
+            model(cond) and returning the field) for fields that need no generative modeling
         shape (_type_): shape of field: b, c, *
         update_f (list): update function for each physics field
         normalize_f (_type_, optional): normalization function for each physics field.
@@ -88,46 +607,118 @@ def compose_diffusion_ddim(
         other_condition (list): other_condition such as initial state, source term.
         num_iter: (int, optional): outer iteration. Defaults to 2.
         device (str, optional): _description_. Defaults to 'cuda'.
+        tol (float, optional): a sample stops the outer iteration once the relative L2 change of all its field
+            estimates between two outer iterations is below tol, and is removed from the batch. Tensors in
+            other_condition must be batch first. Defaults to None, i.e. run num_iter outer iterations.
+        restart_t (int, optional): in outer iterations k > 0, noise the result of the previous outer iteration to
+            timestep restart_t and denoise from there instead of from pure noise at t = T. Defaults to None.
+        snapshot (Snapshot, optional): periodically save the composition state (fields, estimates, RNG state, outer
+            iteration and step) to snapshot.path. Defaults to None.
+        resume (bool, optional): resume from snapshot if its file exists. Defaults to False.
+        yield_every (int, optional): also yield the estimates every yield_every steps. Defaults to None.
+        surrogate_every (int, optional): surrogate fields are evaluated every surrogate_every steps from the first
+            step and at the last step of each outer iteration, their estimate is held in between. None evaluates them
+            at the last step only, the cheapest, but the other fields are then conditioned on noise for them
+            throughout the first outer iteration. Defaults to 1, i.e. every step, which costs as many forwards of
+            the surrogate as of a diffusion field; with surrogate_every = p it takes about 1 / p of them.
+        update_every (list, optional): update period in steps of each field. A field with period p is denoised at
+            every p-th step and at the last step, with one DDIM step spanning the steps it skipped, and its estimate
+            is held in between, so it takes about 1 / p of the denoiser evaluations. Defaults to None, i.e. every
+            field is denoised at every step.
+        anderson (Anderson, optional): extrapolate the estimate each outer iteration k > 0 starts from with Anderson
+            acceleration of the previous outer iterations. Defaults to None, i.e. plain iteration.
+        telemetry (Telemetry, optional): record the time of condition assembly and denoiser of each field at each
+            step, and the relative change of each sample after each outer iteration. Defaults to None.
+    Yields:
+        ComposeState: outer iteration, step (None after an outer iteration) and the unnormalized estimates.
     Returns:
         list: a list contains each field
     """
-    with torch.no_grad():
-
-        batch, device, total_timesteps, sampling_timesteps, eta, objective = (
-            shape[0][0],
-            model_list[0].betas.device,
-            model_list[0].num_timesteps,
-            model_list[0].sampling_timesteps,
-            model_list[0].ddim_sampling_eta,
-            model_list[0].objective,
-        )
+    n_compose = len(model_list)
+    surrogate = [is_surrogate(model) for model in model_list]
+    diffusion = next(model for model in model_list if not is_surrogate(model))
 
-        n_compose = len(model_list)
+    batch, device, total_timesteps, sampling_timesteps, eta, objective = (
+        shape[0][0],
+        diffusion.betas.device,
+        diffusion.num_timesteps,
+        diffusion.sampling_timesteps,
+        diffusion.ddim_sampling_eta,
+        diffusion.objective,
+    )
 
-        times = torch.linspace(
-            -1, total_timesteps - 1, steps=sampling_timesteps + 1
-        )  # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
-        times = list(reversed(times.int().tolist()))
-        time_pairs = list(zip(times[:-1], times[1:]))
+    times = torch.linspace(
+        -1, total_timesteps - 1, steps=sampling_timesteps + 1
+    )  # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
+    times = list(reversed(times.int().tolist()))
+    time_pairs = list(zip(times[:-1], times[1:]))
 
-        # initial field
-        mult_p_estimate = []
-        for s in shape:
-            mult_p_estimate.append(torch.randn(s, device=device))
+    # initial field
+    mult_p_estimate = []
+    for s in shape:
+        mult_p_estimate.append(torch.randn(s, device=device))
+    # samples still iterating and their index in the output
+    index = torch.arange(shape[0][0], device=device)
+    mult_p_out = [torch.zeros(s, device=device) for s in shape]
+    k_start, step_start = 0, 0
+    if anderson is not None:
+        anderson.reset()
+    if resume and snapshot is not None and snapshot.exists():
+        state = snapshot.load()
+        k_start, step_start = state["k"], state["step"]
+        mult_p, mult_p_estimate, mult_p_estimate_before, mult_p_out = [
+            [x.to(device) for x in state[key]]
+            for key in ["mult_p", "mult_p_estimate", "mult_p_estimate_before", "mult_p_out"]
+        ]
+        index = state["index"].to(device)
+        field_time = state["field_time"]
+        if anderson is not None:
+            anderson.x, anderson.g = [[x.to(device) for x in history] for history in state["anderson"]]
+        if len(index) < shape[0][0]:
+            other_condition = [c[index] for c in other_condition]
 
-        for k in range(num_iter):
+    for k in range(k_start, num_iter):
+        begin = telemetry.now() if telemetry is not None else None
+        pairs = time_pairs
+        if k > 0 and restart_t is not None:
+            pairs = [(time, time_next) for time, time_next in time_pairs if time <= restart_t]
+        if k > k_start or step_start == 0:
             mult_p_estimate_before = mult_p_estimate.copy()
+        if k == k_start and step_start > 0:
+            pass  # restored from snapshot
+        elif k > 0 and restart_t is not None:
+            # warm restart from the result of previous outer iteration
+            mult_p_estimate = [e.clone() for e in mult_p_estimate_before]
+            mult_p = [
+                mult_p[i] if surrogate[i] else noise_to(model_list[i], mult_p[i], pairs[0][0]) for i in range(n_compose)
+            ]
+        else:
             mult_p_estimate = []
             mult_p = []
             for s in shape:
+                s = (len(index),) + tuple(s[1:])
                 mult_p_estimate.append(torch.randn(s, device=device))
                 mult_p.append(torch.randn(s, device=device))
-            for time, time_next in tqdm(time_pairs, desc="sampling loop time step"):
-                Lambda = 1 - time_next / (total_timesteps - 1) if k > 0 else 1
+            if k > 0:
+                # surrogate fields keep their estimate until they are evaluated again
                 for i in range(n_compose):
-                    # condition
-                    model = model_list[i]
-                    update = update_f[i]
+                    if surrogate[i]:
+                        mult_p_estimate[i] = mult_p_estimate_before[i].clone()
+        if k > k_start or step_start == 0:
+            # timestep each field has been denoised to
+            field_time = [pairs[0][0]] * n_compose
+        for step in tqdm(range(step_start if k == k_start else 0, len(pairs)), desc="sampling loop time step"):
+            _, time_next = pairs[step]
+            Lambda = 1 - time_next / (total_timesteps - 1) if k > 0 else 1
+            for i in range(n_compose):
+                if surrogate[i] and not surrogate_due(step, len(pairs), surrogate_every):
+                    continue
+                if not surrogate[i] and not field_due(step, len(pairs), update_every and update_every[i]):
+                    continue
+                # condition
+                model = model_list[i]
+                update = update_f[i]
+                with telemetry_span(telemetry, "condition", field=i, k=k, step=step):
                     cond = update(
                         Lambda,
                         mult_p_estimate.copy(),
@@ -136,31 +727,83 @@ def compose_diffusion_ddim(
                         normalize_f,
                         unnormalize_f,
                     )
-                    time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
+                if surrogate[i]:
+                    with telemetry_span(telemetry, "denoise", field=i, k=k, step=step):
+                        mult_p[i] = model(cond)
+                    mult_p_estimate[i] = mult_p[i]
+                    continue
+                time = field_time[i]
+                field_time[i] = time_next
+                time_cond = torch.full((len(index),), time, device=device, dtype=torch.long)
+                with telemetry_span(telemetry, "denoise", field=i, k=k, step=step):
                     pred_noise, x_start, *_ = model.model_predictions(
                         mult_p[i].clone(), time_cond, cond, x_self_cond=None, clip_x_start=clip_denoised
                     )
-                    if time_next < 0:
-                        mult_p[i] = x_start
-                        continue
+                if time_next < 0:
+                    mult_p[i] = x_start
+                    continue
 
-                    alpha = model.alphas_cumprod[time]
-                    alpha_next = model.alphas_cumprod[time_next]
+                alpha = model.alphas_cumprod[time]
+                alpha_next = model.alphas_cumprod[time_next]
 
-                    sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
-                    c = (1 - alpha_next - sigma**2).sqrt()
+                sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
+                c = (1 - alpha_next - sigma**2).sqrt()
 
-                    noise = torch.randn_like(mult_p[i])
+                noise = torch.randn_like(mult_p[i])
 
-                    mult_p[i] = x_start * alpha_next.sqrt() + c * pred_noise + sigma * noise
+                mult_p[i] = x_start * alpha_next.sqrt() + c * pred_noise + sigma * noise
 
-                    # update estimated physics field
+                # update estimated physics field
+
+                mult_p_estimate[i] = model.unnormalize(x_start)
+            if snapshot is not None and snapshot.due():
+                snapshot.save(
+                    {
+                        "k": k,
+                        "step": step + 1,
+                        "mult_p": mult_p,
+                        "mult_p_estimate": mult_p_estimate,
+                        "mult_p_estimate_before": mult_p_estimate_before,
+                        "mult_p_out": mult_p_out,
+                        "index": index,
+                        "anderson": (anderson.x, anderson.g) if anderson is not None else None,
+                        "field_time": field_time,
+                    }
+                )
+            if yield_every is not None and (step + 1) % yield_every == 0:
+                yield ComposeState(k, step + 1, list(mult_p_estimate), index)
+        for i in range(n_compose):
+            mult_p_out[i][index] = mult_p[i]
+        if telemetry is not None:
+            telemetry.outer(k, begin, mult_p_estimate, mult_p_estimate_before, index)
+        yield ComposeState(k, None, list(mult_p_estimate), index)
+        if tol is not None and k > 0:
+            converged = converged_mask(mult_p_estimate, mult_p_estimate_before, tol)
+            if converged.all():
+                break
+        if anderson is not None and k > 0:
+            mult_p_estimate = anderson(mult_p_estimate_before, mult_p_estimate)
+        if tol is not None and k > 0:
+            index = index[~converged]
+            mult_p = [p[~converged] for p in mult_p]
+            mult_p_estimate = [e[~converged] for e in mult_p_estimate]
+            other_condition = [c[~converged] for c in other_condition]
+            if anderson is not None:
+                anderson.keep(~converged)
+    return mult_p_out
 
-                    mult_p_estimate[i] = model.unnormalize(x_start)
-    return mult_p
 
+def compose_diffusion_ddim(*args, **kwargs):
+    """compose diffusion model, see compose_diffusion_ddim_stream for the arguments
 
-def compose_diffusion_multiE(
+    Returns:
+        list: a list contains each field
+    """
+    return run_stream(compose_diffusion_ddim_stream(*args, **kwargs))
+
+
+@torch.no_grad()
+def compose_diffusion_multiE_stream(
     model,
     shape,
     cond_shape,
@@ -172,14 +815,29 @@ def compose_diffusion_multiE(
     other_condition=[],
     num_iter=2,
     device="cuda",
+    tol=None,
+    restart_t=None,
+    n_scenario=None,
+    chunk_size=None,
+    memory_budget=None,
+    snapshot=None,
+    resume=False,
+    yield_every=None,
+    gauss_seidel=False,
+    anderson=None,
+    freeze_tol=None,
+    init_estimate=None,
+    dedup=False,
+    telemetry=None,
 ):
-    """compose diffusion model for multi element.
+    """compose diffusion model for multi element, yielding the estimates while composing.
 
     Args:
         model: conditional diffusion model.
         shape: shape of field.
         update_f: update function physics field.
-        adj (dict): neighbor for each element.
+        adj (dict or CompiledAdjacency): neighbor for each element. A CompiledAdjacency (src/inference/adjacency.py)
+            is passed to update_f as is, so update_f can assemble the condition with adj.assemble.
         normalize_f (_type_, optional): normalization function for each physics field.
         unnormalize_f (_type_, optional): unnormalization function for each physics field.
         boundary_emb: emb function for boundary.
@@ -187,43 +845,197 @@ def compose_diffusion_multiE(
         unnormalize (_type_, optional): unnormalization function for different physics field. Defaults to identity.
         num_iter: (int, optional): outer iteration. Defaults to 2.
         device (str, optional): _description_. Defaults to 'cuda'.
+        tol (float, optional): a scenario stops the outer iteration once the relative L2 change of every element
+            estimate between two outer iterations is below tol: its elements keep their result and are no longer
+            denoised, and the composition stops when every scenario has converged. update_f is then given the
+            estimates of the other scenarios only. Defaults to None, i.e. run num_iter outer iterations.
+        restart_t (int, optional): in outer iterations k > 0, noise the result of the previous outer iteration to
+            timestep restart_t and denoise from there instead of from pure noise at t = T. Defaults to None.
+        n_scenario (int, optional): denoise n_scenario independent scenarios (e.g. load cases) of the assembly in
+            one batch of n_scenario * n_element, scenario major. Tensors in other_condition are then per scenario
+            and element, shape: n_scenario * n_element, *, and adj should be a CompiledAdjacency, which gathers
+            neighbors within each scenario. Defaults to None, i.e. a single scenario.
+        chunk_size (int, optional): evaluate the denoiser on chunk_size elements at a time each step, writing into
+            the state of the whole assembly. The result is that without chunking up to the rounding of kernels on
+            smaller batches. Defaults to None.
+        memory_budget (float, optional): memory budget (GB) of one forward on cuda, used to choose chunk_size when
+            it is not given. Defaults to None.
+        snapshot (Snapshot, optional): periodically save the composition state (fields, estimates, RNG state, outer
+            iteration and step) to snapshot.path. Defaults to None.
+        resume (bool, optional): resume from snapshot if its file exists. Defaults to False.
+        yield_every (int, optional): also yield the estimates every yield_every steps. Defaults to None.
+        gauss_seidel (bool, optional): denoise the colour classes of adj (a CompiledAdjacency) one after another in
+            each step, each conditioned on the freshest estimates of its neighbors, instead of all elements from the
+            estimates of the previous step. Converges in fewer outer iterations. Defaults to False.
+        anderson (Anderson, optional): extrapolate the estimate each outer iteration k > 0 starts from with Anderson
+            acceleration of the previous outer iterations. Defaults to None, i.e. plain iteration.
+        freeze_tol (float, optional): freeze an element once the relative L2 change of its estimate between two
+            outer iterations is below freeze_tol (in every scenario). Frozen elements keep their result, are no longer
+            denoised and only supply boundary conditions to their neighbors. adj should be a CompiledAdjacency.
+            Defaults to None.
+        init_estimate (Tensor, optional): initial guess of the field of all elements, shape: n_batch, *, e.g. from a
+            coarse model of the whole assembly with one node per element (see coarse_estimate in heatpipe.py). The
+            first outer iteration then starts from it as if it were the result of a previous outer iteration, so
+            with restart_t the element-wise diffusion only corrects local detail. Defaults to None.
+        dedup (bool, optional): denoise only one of the elements with identical state and condition in each step
+            and scatter its result to the others. Element fields are in the frame of element 1 (read_e maps each
+            block onto it with coord_transform, i.e. move_block and sym_block), so elements equal up to these
+            symmetries are detected as duplicates. Elements with identical other_condition share their noise.
+            Defaults to False.
+        telemetry (Telemetry, optional): record the time of condition assembly and denoiser of each batch of
+            elements (see gauss_seidel) at each step, and the relative change of each element after each outer
+            iteration. Defaults to None.
+    Yields:
+        ComposeState: outer iteration, step (None after an outer iteration) and the unnormalized estimates.
     Returns:
-        Tensor: a tensor of multiphysics field
+        Tensor: a tensor of multiphysics field, shape: n_element, * or n_scenario, n_element, * with n_scenario
     """
-    with torch.no_grad():
-
-        n_compose = len(adj)
+    n_compose = len(adj)
+    n_batch = n_compose * (n_scenario or 1)
 
-        timestep = model.num_timesteps
+    timestep = model.num_timesteps
 
-        # initial field
-        mult_e_estimate = torch.randn((n_compose,) + shape).to(device)
-        # for i in range(n_compose):
-        #     mult_p_estimate.append(torch.randn(shape, device=device))
+    # initial field
+    # elements with identical other_condition share their noise with dedup
+    shared = dedup_index(n_batch, *condition_tensors(other_condition, n_batch))[1] if dedup else None
+    # initial guess, treated as the result of an outer iteration before the first
+    warm = init_estimate is not None
+    if warm:
+        mult_e_estimate = init_estimate.to(device)
+        mult_e = model.normalize(mult_e_estimate)
+    else:
+        mult_e_estimate = randn_rows(n_batch, shape, device, shared)
+    # for i in range(n_compose):
+    #     mult_p_estimate.append(torch.randn(shape, device=device))
+    k_start, step_start = 0, 0
+    if anderson is not None:
+        anderson.reset()
+    # elements frozen by freeze_tol and scenarios converged within tol
+    frozen = torch.zeros(n_compose, dtype=torch.bool) if freeze_tol is not None else None
+    done = torch.zeros(n_scenario or 1, dtype=torch.bool) if tol is not None else None
+    if resume and snapshot is not None and snapshot.exists():
+        state = snapshot.load()
+        k_start, step_start = state["k"], state["step"]
+        mult_e, mult_e_estimate, mult_e_estimate_before = [
+            state[key].to(device) for key in ["mult_e", "mult_e_estimate", "mult_e_estimate_before"]
+        ]
+        if anderson is not None:
+            anderson.x, anderson.g = [[x.to(device) for x in history] for history in state["anderson"]]
+        frozen, done = state["frozen"], state["done"]
+    sweep = sweep_classes(adj, n_scenario, gauss_seidel, frozen, done)
+    rows = scenario_rows(done, n_compose, device)
 
-        for k in range(num_iter):
+    for k in range(k_start, num_iter):
+        begin = telemetry.now() if telemetry is not None else None
+        if k > k_start or step_start == 0:
             mult_e_estimate_before = mult_e_estimate.clone()
-            mult_e_estimate = torch.randn((n_compose,) + shape).to(device)
-            mult_e = torch.randn((n_compose,) + shape).to(device)
-            for t in tqdm(reversed(range(0, timestep)), desc="sampling loop time step", total=timestep):
-                alpha = 1 - t / (timestep - 1) if k > 0 else 1
-                cond = update_f(
-                    alpha,
-                    adj,
-                    cond_shape,
-                    boundary_emb,
-                    mult_e_estimate.clone(),
-                    mult_e_estimate_before.clone(),
-                    other_condition,
-                    normalize_f,
-                    unnormalize_f,
+        mult_e_last = mult_e if k > k_start else None
+        if k == k_start and step_start > 0:
+            pass  # restored from snapshot
+        elif (k > 0 or warm) and restart_t is not None:
+            # warm restart from the result of previous outer iteration
+            mult_e = noise_to(model, mult_e, restart_t, randn_rows(n_batch, shape, device, shared) if dedup else None)
+        else:
+            mult_e_estimate = randn_rows(n_batch, shape, device, shared)
+            mult_e = randn_rows(n_batch, shape, device, shared)
+        keep = kept_rows(frozen, done, n_compose, n_scenario)
+        if k > k_start and keep is not None:
+            # frozen elements and converged scenarios keep their result and estimate
+            keep = keep.to(device).reshape((-1,) + (1,) * len(shape))
+            mult_e = torch.where(keep, mult_e_last, mult_e)
+            mult_e_estimate = torch.where(keep, mult_e_estimate_before, mult_e_estimate)
+        steps = list(reversed(range(0, restart_t + 1 if (k > 0 or warm) and restart_t is not None else timestep)))
+        for step in tqdm(range(step_start if k == k_start else 0, len(steps)), desc="sampling loop time step"):
+            t = steps[step]
+            alpha = 1 - t / (timestep - 1) if (k > 0 or warm) else 1
+            for b, (adj_c, index_c) in enumerate(sweep):
+                with telemetry_span(telemetry, "condition", batch=b, k=k, step=step):
+                    cond = update_f(
+                        alpha,
+                        adj_c,
+                        cond_shape,
+                        boundary_emb,
+                        mult_e_estimate.clone() if rows is None else mult_e_estimate[rows],
+                        mult_e_estimate_before.clone() if rows is None else mult_e_estimate_before[rows],
+                        other_condition if index_c is None else slice_condition(other_condition, index_c, n_batch),
+                        normalize_f,
+                        unnormalize_f,
+                    )
+                x = mult_e if index_c is None else mult_e[index_c]
+                if dedup:
+                    first, inverse = dedup_index(x.shape[0], x, *condition_tensors(cond, x.shape[0]))
+                    x, cond = x[first], slice_condition(cond, first, x.shape[0])
+                if chunk_size is None and memory_budget is not None:
+                    time_cond = torch.full((x.shape[0],), t, device=x.device, dtype=torch.long)
+                    chunk_size = probe_chunk_size(model, x, time_cond, cond, memory_budget)
+                with telemetry_span(telemetry, "denoise", batch=b, k=k, step=step):
+                    if chunk_size is None:
+                        x, x0 = model.p_sample(x.clone(), t, cond)
+                    else:
+                        x, x0 = p_sample_chunked(model, x, t, cond, chunk_size)
+                x0 = model.unnormalize(x0)
+                if dedup:
+                    x, x0 = x[inverse], x0[inverse]
+                if index_c is None:
+                    mult_e, mult_e_estimate = x, x0
+                else:
+                    mult_e = mult_e.index_copy(0, index_c, x)
+                    mult_e_estimate = mult_e_estimate.index_copy(0, index_c, x0)
+            if snapshot is not None and snapshot.due():
+                snapshot.save(
+                    {
+                        "k": k,
+                        "step": step + 1,
+                        "mult_e": mult_e,
+                        "mult_e_estimate": mult_e_estimate,
+                        "mult_e_estimate_before": mult_e_estimate_before,
+                        "anderson": (anderson.x, anderson.g) if anderson is not None else None,
+                        "frozen": frozen,
+                        "done": done,
+                    }
                 )
-                mult_e, x0 = model.p_sample(mult_e.clone(), t, cond)
-                mult_e_estimate = model.unnormalize(x0)
+            if yield_every is not None and (step + 1) % yield_every == 0:
+                yield ComposeState(k, step + 1, mult_e_estimate, None)
+        if telemetry is not None:
+            telemetry.outer(k, begin, [mult_e_estimate], [mult_e_estimate_before])
+        yield ComposeState(k, None, mult_e_estimate, None)
+        if (tol is not None or freeze_tol is not None) and (k > 0 or warm):
+            if tol is not None:
+                converged = converged_mask([mult_e_estimate], [mult_e_estimate_before], tol)
+                done = done | converged.reshape(n_scenario or 1, n_compose).all(dim=1).cpu()
+            if freeze_tol is not None:
+                change = relative_change(mult_e_estimate, mult_e_estimate_before).reshape(n_scenario or 1, n_compose)
+                frozen = frozen | (change.amax(dim=0) < freeze_tol).cpu()
+            if (done is not None and done.all()) or (frozen is not None and frozen.all()):
+                break
+            sweep = sweep_classes(adj, n_scenario, gauss_seidel, frozen, done)
+            rows = scenario_rows(done, n_compose, device)
+        if anderson is not None and (k > 0 or warm):
+            n_vector = n_scenario or 1
+            mixed = anderson(
+                mult_e_estimate_before.reshape(n_vector, -1), mult_e_estimate.reshape(n_vector, -1)
+            ).reshape(mult_e_estimate.shape)
+            # frozen elements and converged scenarios keep their estimate
+            keep = kept_rows(frozen, done, n_compose, n_scenario)
+            if keep is not None:
+                mixed = torch.where(keep.to(device).reshape((-1,) + (1,) * len(shape)), mult_e_estimate, mixed)
+            mult_e_estimate = mixed
+    if n_scenario is not None:
+        return mult_e.reshape((n_scenario, n_compose) + tuple(shape))
     return mult_e
 
 
-def compose_diffusion_multiE_ddim(
+def compose_diffusion_multiE(*args, **kwargs):
+    """compose diffusion model for multi element, see compose_diffusion_multiE_stream for the arguments
+
+    Returns:
+        Tensor: a tensor of multiphysics field
+    """
+    return run_stream(compose_diffusion_multiE_stream(*args, **kwargs))
+
+
+@torch.no_grad()
+def compose_diffusion_multiE_ddim_stream(
     model,
     shape,
     cond_shape,
@@ -236,14 +1048,29 @@ def compose_diffusion_multiE_ddim(
     num_iter=2,
     device="cuda",
     clip_denoised=True,
+    tol=None,
+    restart_t=None,
+    n_scenario=None,
+    chunk_size=None,
+    memory_budget=None,
+    snapshot=None,
+    resume=False,
+    yield_every=None,
+    gauss_seidel=False,
+    anderson=None,
+    freeze_tol=None,
+    init_estimate=None,
+    dedup=False,
+    telemetry=None,
 ):
-    """compose diffusion model for multi element.
+    """compose diffusion model for multi element, yielding the estimates while composing.
 
     Args:
         model: conditional diffusion model.
         shape: shape of field.
         update_f: update function physics field.
-        adj (dict): neighbor for each element.
+        adj (dict or CompiledAdjacency): neighbor for each element. A CompiledAdjacency (src/inference/adjacency.py)
+            is passed to update_f as is, so update_f can assemble the condition with adj.assemble.
         normalize_f (_type_, optional): normalization function for each physics field.
         unnormalize_f (_type_, optional): unnormalization function for each physics field.
         boundary_emb: emb function for boundary.
@@ -251,54 +1078,153 @@ def compose_diffusion_multiE_ddim(
         unnormalize (_type_, optional): unnormalization function for different physics field. Defaults to identity.
         num_iter: (int, optional): outer iteration. Defaults to 2.
         device (str, optional): _description_. Defaults to 'cuda'.
+        tol (float, optional): a scenario stops the outer iteration once the relative L2 change of every element
+            estimate between two outer iterations is below tol: its elements keep their result and are no longer
+            denoised, and the composition stops when every scenario has converged. update_f is then given the
+            estimates of the other scenarios only. Defaults to None, i.e. run num_iter outer iterations.
+        restart_t (int, optional): in outer iterations k > 0, noise the result of the previous outer iteration to
+            timestep restart_t and denoise from there instead of from pure noise at t = T. Defaults to None.
+        n_scenario (int, optional): denoise n_scenario independent scenarios (e.g. load cases) of the assembly in
+            one batch of n_scenario * n_element, scenario major. Tensors in other_condition are then per scenario
+            and element, shape: n_scenario * n_element, *, and adj should be a CompiledAdjacency, which gathers
+            neighbors within each scenario. Defaults to None, i.e. a single scenario.
+        chunk_size (int, optional): evaluate the denoiser on chunk_size elements at a time each step, writing into
+            the state of the whole assembly. The result is that without chunking up to the rounding of kernels on
+            smaller batches. Defaults to None.
+        memory_budget (float, optional): memory budget (GB) of one forward on cuda, used to choose chunk_size when
+            it is not given. Defaults to None.
+        snapshot (Snapshot, optional): periodically save the composition state (fields, estimates, RNG state, outer
+            iteration and step) to snapshot.path. Defaults to None.
+        resume (bool, optional): resume from snapshot if its file exists. Defaults to False.
+        yield_every (int, optional): also yield the estimates every yield_every steps. Defaults to None.
+        gauss_seidel (bool, optional): denoise the colour classes of adj (a CompiledAdjacency) one after another in
+            each step, each conditioned on the freshest estimates of its neighbors, instead of all elements from the
+            estimates of the previous step. Converges in fewer outer iterations. Defaults to False.
+        anderson (Anderson, optional): extrapolate the estimate each outer iteration k > 0 starts from with Anderson
+            acceleration of the previous outer iterations. Defaults to None, i.e. plain iteration.
+        freeze_tol (float, optional): freeze an element once the relative L2 change of its estimate between two
+            outer iterations is below freeze_tol (in every scenario). Frozen elements keep their result, are no longer
+            denoised and only supply boundary conditions to their neighbors. adj should be a CompiledAdjacency.
+            Defaults to None.
+        init_estimate (Tensor, optional): initial guess of the field of all elements, shape: n_batch, *, e.g. from a
+            coarse model of the whole assembly with one node per element (see coarse_estimate in heatpipe.py). The
+            first outer iteration then starts from it as if it were the result of a previous outer iteration, so
+            with restart_t the element-wise diffusion only corrects local detail. Defaults to None.
+        dedup (bool, optional): denoise only one of the elements with identical state and condition in each step
+            and scatter its result to the others. Element fields are in the frame of element 1 (read_e maps each
+            block onto it with coord_transform, i.e. move_block and sym_block), so elements equal up to these
+            symmetries are detected as duplicates. Elements with identical other_condition share their noise.
+            Defaults to False.
+        telemetry (Telemetry, optional): record the time of condition assembly and denoiser of each batch of
+            elements (see gauss_seidel) at each step, and the relative change of each element after each outer
+            iteration. Defaults to None.
+    Yields:
+        ComposeState: outer iteration, step (None after an outer iteration) and the unnormalized estimates.
     Returns:
-        Tensor: a tensor of multiphysics field
+        Tensor: a tensor of multiphysics field, shape: n_element, * or n_scenario, n_element, * with n_scenario
     """
-    with torch.no_grad():
-
-        batch, device, total_timesteps, sampling_timesteps, eta, objective = (
-            len(adj),
-            model.betas.device,
-            model.num_timesteps,
-            model.sampling_timesteps,
-            model.ddim_sampling_eta,
-            model.objective,
-        )
+    batch, device, total_timesteps, sampling_timesteps, eta, objective = (
+        len(adj) * (n_scenario or 1),
+        model.betas.device,
+        model.num_timesteps,
+        model.sampling_timesteps,
+        model.ddim_sampling_eta,
+        model.objective,
+    )
 
-        n_compose = len(adj)
+    n_compose = len(adj)
 
-        times = torch.linspace(
-            -1, total_timesteps - 1, steps=sampling_timesteps + 1
-        )  # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
-        times = list(reversed(times.int().tolist()))
-        time_pairs = list(zip(times[:-1], times[1:]))
+    times = torch.linspace(
+        -1, total_timesteps - 1, steps=sampling_timesteps + 1
+    )  # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
+    times = list(reversed(times.int().tolist()))
+    time_pairs = list(zip(times[:-1], times[1:]))
 
-        # initial field
-        mult_e_estimate = torch.randn((n_compose,) + shape).to(device)
+    # initial field
+    # elements with identical other_condition share their noise with dedup
+    shared = dedup_index(batch, *condition_tensors(other_condition, batch))[1] if dedup else None
+    # initial guess, treated as the result of an outer iteration before the first
+    warm = init_estimate is not None
+    if warm:
+        mult_e_estimate = init_estimate.to(device)
+        mult_e = model.normalize(mult_e_estimate)
+    else:
+        mult_e_estimate = randn_rows(batch, shape, device, shared)
+    k_start, step_start = 0, 0
+    if anderson is not None:
+        anderson.reset()
+    # elements frozen by freeze_tol and scenarios converged within tol
+    frozen = torch.zeros(n_compose, dtype=torch.bool) if freeze_tol is not None else None
+    done = torch.zeros(n_scenario or 1, dtype=torch.bool) if tol is not None else None
+    if resume and snapshot is not None and snapshot.exists():
+        state = snapshot.load()
+        k_start, step_start = state["k"], state["step"]
+        mult_e, mult_e_estimate, mult_e_estimate_before = [
+            state[key].to(device) for key in ["mult_e", "mult_e_estimate", "mult_e_estimate_before"]
+        ]
+        if anderson is not None:
+            anderson.x, anderson.g = [[x.to(device) for x in history] for history in state["anderson"]]
+        frozen, done = state["frozen"], state["done"]
+    sweep = sweep_classes(adj, n_scenario, gauss_seidel, frozen, done)
+    rows = scenario_rows(done, n_compose, device)
 
-        for k in range(num_iter):
+    for k in range(k_start, num_iter):
+        begin = telemetry.now() if telemetry is not None else None
+        pairs = time_pairs
+        if (k > 0 or warm) and restart_t is not None:
+            pairs = [(time, time_next) for time, time_next in time_pairs if time <= restart_t]
+        if k > k_start or step_start == 0:
             mult_e_estimate_before = mult_e_estimate.clone()
-            mult_e_estimate = torch.randn((n_compose,) + shape).to(device)
-            mult_e = torch.randn((n_compose,) + shape).to(device)
-            for time, time_next in tqdm(time_pairs, desc="sampling loop time step"):
-                Lambda = 1 - time_next / (total_timesteps - 1) if k > 0 else 1
-                cond = update_f(
-                    Lambda,
-                    adj,
-                    cond_shape,
-                    boundary_emb,
-                    mult_e_estimate.clone(),
-                    mult_e_estimate_before.clone(),
-                    other_condition,
-                    normalize_f,
-                    unnormalize_f,
-                )
-                time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
-                pred_noise, x_start, *_ = model.model_predictions(
-                    mult_e, time_cond, cond, x_self_cond=None, clip_x_start=clip_denoised
-                )
+        mult_e_last = mult_e if k > k_start else None
+        if k == k_start and step_start > 0:
+            pass  # restored from snapshot
+        elif (k > 0 or warm) and restart_t is not None:
+            # warm restart from the result of previous outer iteration
+            mult_e = noise_to(model, mult_e, pairs[0][0], randn_rows(batch, shape, device, shared) if dedup else None)
+        else:
+            mult_e_estimate = randn_rows(batch, shape, device, shared)
+            mult_e = randn_rows(batch, shape, device, shared)
+        keep = kept_rows(frozen, done, n_compose, n_scenario)
+        if k > k_start and keep is not None:
+            # frozen elements and converged scenarios keep their result and estimate
+            keep = keep.to(device).reshape((-1,) + (1,) * len(shape))
+            mult_e = torch.where(keep, mult_e_last, mult_e)
+            mult_e_estimate = torch.where(keep, mult_e_estimate_before, mult_e_estimate)
+        for step in tqdm(range(step_start if k == k_start else 0, len(pairs)), desc="sampling loop time step"):
+            time, time_next = pairs[step]
+            Lambda = 1 - time_next / (total_timesteps - 1) if (k > 0 or warm) else 1
+            for b, (adj_c, index_c) in enumerate(sweep):
+                with telemetry_span(telemetry, "condition", batch=b, k=k, step=step):
+                    cond = update_f(
+                        Lambda,
+                        adj_c,
+                        cond_shape,
+                        boundary_emb,
+                        mult_e_estimate.clone() if rows is None else mult_e_estimate[rows],
+                        mult_e_estimate_before.clone() if rows is None else mult_e_estimate_before[rows],
+                        other_condition if index_c is None else slice_condition(other_condition, index_c, batch),
+                        normalize_f,
+                        unnormalize_f,
+                    )
+                x = mult_e if index_c is None else mult_e[index_c]
+                if dedup:
+                    first, inverse = dedup_index(x.shape[0], x, *condition_tensors(cond, x.shape[0]))
+                    x, cond = x[first], slice_condition(cond, first, x.shape[0])
+                time_cond = torch.full((x.shape[0],), time, device=device, dtype=torch.long)
+                if chunk_size is None and memory_budget is not None:
+                    chunk_size = probe_chunk_size(model, x, time_cond, cond, memory_budget)
+                with telemetry_span(telemetry, "denoise", batch=b, k=k, step=step):
+                    if chunk_size is None:
+                        pred_noise, x_start, *_ = model.model_predictions(
+                            x, time_cond, cond, x_self_cond=None, clip_x_start=clip_denoised
+                        )
+                    else:
+                        pred_noise, x_start = model_predictions_chunked(
+                            model, x, time_cond, cond, chunk_size, clip_x_start=clip_denoised
+                        )
                 if time_next < 0:
-                    mult_e = x_start
+                    x_start = x_start[inverse] if dedup else x_start
+                    mult_e = x_start if index_c is None else mult_e.index_copy(0, index_c, x_start)
                     continue
 
                 alpha = model.alphas_cumprod[time]
@@ -307,11 +1233,70 @@ def compose_diffusion_multiE_ddim(
                 sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
                 c = (1 - alpha_next - sigma**2).sqrt()
 
-                noise = torch.randn_like(mult_e)
+                noise = torch.randn_like(x)
 
-                mult_e = x_start * alpha_next.sqrt() + c * pred_noise + sigma * noise
+                x = x_start * alpha_next.sqrt() + c * pred_noise + sigma * noise
 
                 # update estimated physics field
 
-                mult_e_estimate = model.unnormalize(x_start)
+                x_start = model.unnormalize(x_start)
+                if dedup:
+                    x, x_start = x[inverse], x_start[inverse]
+                if index_c is None:
+                    mult_e, mult_e_estimate = x, x_start
+                else:
+                    mult_e = mult_e.index_copy(0, index_c, x)
+                    mult_e_estimate = mult_e_estimate.index_copy(0, index_c, x_start)
+            if time_next < 0:
+                continue
+            if snapshot is not None and snapshot.due():
+                snapshot.save(
+                    {
+                        "k": k,
+                        "step": step + 1,
+                        "mult_e": mult_e,
+                        "mult_e_estimate": mult_e_estimate,
+                        "mult_e_estimate_before": mult_e_estimate_before,
+                        "anderson": (anderson.x, anderson.g) if anderson is not None else None,
+                        "frozen": frozen,
+                        "done": done,
+                    }
+                )
+            if yield_every is not None and (step + 1) % yield_every == 0:
+                yield ComposeState(k, step + 1, mult_e_estimate, None)
+        if telemetry is not None:
+            telemetry.outer(k, begin, [mult_e_estimate], [mult_e_estimate_before])
+        yield ComposeState(k, None, mult_e_estimate, None)
+        if (tol is not None or freeze_tol is not None) and (k > 0 or warm):
+            if tol is not None:
+                converged = converged_mask([mult_e_estimate], [mult_e_estimate_before], tol)
+                done = done | converged.reshape(n_scenario or 1, n_compose).all(dim=1).cpu()
+            if freeze_tol is not None:
+                change = relative_change(mult_e_estimate, mult_e_estimate_before).reshape(n_scenario or 1, n_compose)
+                frozen = frozen | (change.amax(dim=0) < freeze_tol).cpu()
+            if (done is not None and done.all()) or (frozen is not None and frozen.all()):
+                break
+            sweep = sweep_classes(adj, n_scenario, gauss_seidel, frozen, done)
+            rows = scenario_rows(done, n_compose, device)
+        if anderson is not None and (k > 0 or warm):
+            n_vector = n_scenario or 1
+            mixed = anderson(
+                mult_e_estimate_before.reshape(n_vector, -1), mult_e_estimate.reshape(n_vector, -1)
+            ).reshape(mult_e_estimate.shape)
+            # frozen elements and converged scenarios keep their estimate
+            keep = kept_rows(frozen, done, n_compose, n_scenario)
+            if keep is not None:
+                mixed = torch.where(keep.to(device).reshape((-1,) + (1,) * len(shape)), mult_e_estimate, mixed)
+            mult_e_estimate = mixed
+    if n_scenario is not None:
+        return mult_e.reshape((n_scenario, n_compose) + tuple(shape))
     return mult_e
+
+
+def compose_diffusion_multiE_ddim(*args, **kwargs):
+    """compose diffusion model for multi element, see compose_diffusion_multiE_ddim_stream for the arguments
+
+    Returns:
+        Tensor: a tensor of multiphysics field
+    """
+    return run_stream(compose_diffusion_multiE_ddim_stream(*args, **kwargs))
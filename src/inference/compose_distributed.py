@@ -0,0 +1,320 @@
+import argparse
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+from tqdm.auto import tqdm
+import sys, os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from filepath import ABSOLUTE_PATH
+
+sys.path.append(ABSOLUTE_PATH)
+from src.inference.adjacency import CompiledAdjacency
+from src.inference.compose import relative_change, noise_to, model_predictions_chunked, slice_condition
+from src.inference.heatpipe import neighbors, boundary_emb_f, tile_assembly, update
+from src.model.transolver import Transolver
+from src.model.diffusion import GaussianDiffusion
+
+
+class HaloPlan(object):
+    """contiguous partition of elements over ranks, and the elements each rank exchanges with the others per step.
+
+    Each rank keeps the field of its elements followed by its halo (neighbors owned by other ranks), in the order of
+    elements; send and recv index positions in this local field.
+    """
+
+    def __init__(self, adj, rank, world_size):
+        """
+        Args:
+            adj (CompiledAdjacency): adjacency of the whole assembly.
+            rank (int): rank of this process.
+            world_size (int): number of processes.
+        """
+        n_element = len(adj)
+        assert n_element >= world_size, "more workers than elements"
+        self.partition = torch.tensor_split(torch.arange(n_element), world_size)
+        self.owned = slice(int(self.partition[rank][0]), int(self.partition[rank][-1]) + 1)
+        self.n_owned = len(self.partition[rank])
+        owner = torch.zeros(n_element, dtype=torch.long)
+        for r, part in enumerate(self.partition):
+            owner[part] = r
+        # neighbors (not boundaries) needed by the elements of each rank
+        neighbor_index, boundary_mask = adj.neighbor_index.cpu(), adj.boundary_mask.cpu()
+        needed = [torch.unique(neighbor_index[part][~boundary_mask[part]]) for part in self.partition]
+        halo = needed[rank][owner[needed[rank]] != rank]
+        # global index of the elements of the local field, and position of each global element in it
+        self.elements = torch.concat((self.partition[rank], halo))
+        position = torch.full((n_element,), -1, dtype=torch.long)
+        position[self.elements] = torch.arange(len(self.elements))
+        self.send, self.recv = {}, {}
+        for q in range(world_size):
+            if q == rank:
+                continue
+            send_q = needed[q][owner[needed[q]] == rank]
+            recv_q = needed[rank][owner[needed[rank]] == q]
+            if len(send_q) > 0:
+                self.send[q] = position[send_q]
+            if len(recv_q) > 0:
+                self.recv[q] = position[recv_q]
+
+
+def halo_exchange(buffer, plan):
+    """send owned elements of the local field buffer needed by other ranks and receive the halo of this rank, in place.
+
+    Communication goes through cpu tensors, so it runs with the gloo backend.
+    """
+    requests, sent, received = [], [], {}
+    for q, index in plan.send.items():
+        sent.append(buffer[index.to(buffer.device)].cpu().contiguous())
+        requests.append(dist.isend(sent[-1], q))
+    for q, index in plan.recv.items():
+        received[q] = torch.empty((len(index),) + tuple(buffer.shape[1:]), dtype=buffer.dtype)
+        requests.append(dist.irecv(received[q], q))
+    for request in requests:
+        request.wait()
+    for q, index in plan.recv.items():
+        buffer[index.to(buffer.device)] = received[q].to(buffer.device)
+    return buffer
+
+
+def gather_elements(local, plan):
+    """gather the owned elements of every rank into the field of the whole assembly on every rank"""
+    max_len = max(len(part) for part in plan.partition)
+    padded = torch.zeros((max_len,) + tuple(local.shape[1:]), dtype=local.dtype)
+    padded[: local.shape[0]] = local.cpu()
+    gathered = [torch.empty_like(padded) for _ in plan.partition]
+    dist.all_gather(gathered, padded)
+    return torch.concat([g[: len(part)] for g, part in zip(gathered, plan.partition)]).to(local.device)
+
+
+def compose_diffusion_multiE_ddim_distributed(
+    model,
+    shape,
+    cond_shape,
+    update_f,
+    adj,
+    boundary_emb,
+    normalize_f=nn.Identity(),
+    unnormalize_f=nn.Identity(),
+    other_condition=[],
+    num_iter=2,
+    clip_denoised=True,
+    tol=None,
+    restart_t=None,
+    chunk_size=None,
+):
+    """compose diffusion model for multi element, with elements partitioned over the processes of torch.distributed.
+
+    Call it on every rank after dist.init_process_group (see run_distributed). Each rank denoises a contiguous block
+    of elements, and after each step exchanges only the estimates of elements that are neighbors of another rank's
+    elements (halo). Each rank only holds the estimates of its elements and their halo, so memory and update work per
+    rank scale with the elements per rank. update_f gets the CompiledAdjacency of the owned elements, gathering from
+    this local estimate (see HaloPlan), and the local estimate.
+
+    Args:
+        model: conditional diffusion model.
+        shape: shape of field.
+        update_f: update function physics field, should assemble the condition with adj.assemble.
+        adj (dict or CompiledAdjacency): neighbor for each element.
+        boundary_emb: emb function for boundary.
+        normalize_f (_type_, optional): normalization function for each physics field.
+        unnormalize_f (_type_, optional): unnormalization function for each physics field.
+        other_condition (list): other_condition such as initial state, source term. The shape of list element is b, *
+        num_iter: (int, optional): outer iteration. Defaults to 2.
+        tol (float, optional): see compose_diffusion_multiE_ddim. Defaults to None.
+        restart_t (int, optional): see compose_diffusion_multiE_ddim. Defaults to None.
+        chunk_size (int, optional): see compose_diffusion_multiE_ddim. Defaults to None.
+    Returns:
+        Tensor: a tensor of multiphysics field of all elements, on every rank
+    """
+    with torch.no_grad():
+
+        device, total_timesteps, sampling_timesteps, eta = (
+            model.betas.device,
+            model.num_timesteps,
+            model.sampling_timesteps,
+            model.ddim_sampling_eta,
+        )
+        if not isinstance(adj, CompiledAdjacency):
+            adj = CompiledAdjacency(adj, boundary_emb, device=device)
+
+        n_compose = len(adj)
+        plan = HaloPlan(adj, dist.get_rank(), dist.get_world_size())
+        owned = plan.owned
+        local_adj = adj.restrict(torch.arange(n_compose)[owned], plan.elements)
+        local_condition = slice_condition(other_condition, owned, n_compose)
+        batch = len(local_adj)
+        n_local = len(plan.elements)
+
+        times = torch.linspace(
+            -1, total_timesteps - 1, steps=sampling_timesteps + 1
+        )  # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
+        times = list(reversed(times.int().tolist()))
+        time_pairs = list(zip(times[:-1], times[1:]))
+
+        # initial field, estimate of the owned elements followed by the halo
+        mult_e_estimate = halo_exchange(torch.randn((n_local,) + shape).to(device), plan)
+
+        for k in range(num_iter):
+            mult_e_estimate_before = mult_e_estimate.clone()
+            if k > 0 and restart_t is not None:
+                # warm restart from the result of previous outer iteration
+                pairs = [(time, time_next) for time, time_next in time_pairs if time <= restart_t]
+                mult_e = noise_to(model, mult_e, pairs[0][0])
+            else:
+                pairs = time_pairs
+                mult_e_estimate = halo_exchange(torch.randn((n_local,) + shape).to(device), plan)
+                mult_e = torch.randn((batch,) + shape).to(device)
+            for time, time_next in tqdm(pairs, desc="sampling loop time step", disable=dist.get_rank() != 0):
+                Lambda = 1 - time_next / (total_timesteps - 1) if k > 0 else 1
+                cond = update_f(
+                    Lambda,
+                    local_adj,
+                    cond_shape,
+                    boundary_emb,
+                    mult_e_estimate.clone(),
+                    mult_e_estimate_before.clone(),
+                    local_condition,
+                    normalize_f,
+                    unnormalize_f,
+                )
+                time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
+                if chunk_size is None:
+                    pred_noise, x_start, *_ = model.model_predictions(
+                        mult_e, time_cond, cond, x_self_cond=None, clip_x_start=clip_denoised
+                    )
+                else:
+                    pred_noise, x_start = model_predictions_chunked(
+                        model, mult_e, time_cond, cond, chunk_size, clip_x_start=clip_denoised
+                    )
+                if time_next < 0:
+                    mult_e = x_start
+                    continue
+
+                alpha = model.alphas_cumprod[time]
+                alpha_next = model.alphas_cumprod[time_next]
+
+                sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
+                c = (1 - alpha_next - sigma**2).sqrt()
+
+                noise = torch.randn_like(mult_e)
+
+                mult_e = x_start * alpha_next.sqrt() + c * pred_noise + sigma * noise
+
+                # update estimated physics field and exchange the halo
+
+                mult_e_estimate[:batch] = model.unnormalize(x_start)
+                halo_exchange(mult_e_estimate, plan)
+            if tol is not None and k > 0:
+                change = relative_change(mult_e_estimate[:batch], mult_e_estimate_before[:batch]).max().cpu()
+                dist.all_reduce(change, op=dist.ReduceOp.MAX)
+                if change < tol:
+                    break
+    return gather_elements(mult_e, plan)
+
+
+def _worker(rank, world_size, fn, args, port):
+    dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=world_size)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def run_distributed(world_size, fn, *args, port=29500):
+    """run fn(rank, world_size, *args) on world_size local processes with the gloo backend"""
+    mp.spawn(_worker, args=(world_size, fn, args, port), nprocs=world_size, join=True)
+
+
+def benchmark_worker(rank, world_size, args, n_copy, queue):
+    torch.set_num_threads(args.threads)
+    # same (untrained) weights on every rank, different noise
+    torch.manual_seed(args.seed)
+    model = Transolver(
+        space_dim=2,
+        n_layers=args.n_layer,
+        n_hidden=args.hidden_dim,
+        dropout=0.0,
+        n_head=8,
+        Time_Input=True,
+        act="gelu",
+        mlp_ratio=1,
+        fun_dim=13,
+        out_dim=3,
+        slice_num=16,
+        ref=8,
+        unified_pos=False,
+    )
+    diffusion = GaussianDiffusion(
+        model,
+        seq_length=tuple([804, 3]),
+        timesteps=args.diffusion_step,
+        sampling_timesteps=args.ddim_step,
+        auto_normalize=False,
+    )
+    torch.manual_seed(args.seed + rank)
+    adj = CompiledAdjacency(tile_assembly(neighbors, n_copy), boundary_emb_f, device="cpu")
+    coord = (torch.rand(804, 2) * 2 - 1).expand(len(adj), -1, -1)
+    flux = torch.rand(len(adj)) * 2 - 1
+
+    dist.barrier()
+    start, cpu_start = time.time(), time.process_time()
+    compose_diffusion_multiE_ddim_distributed(
+        diffusion, (804, 3), 10, update, adj, boundary_emb_f, other_condition=[coord, flux], num_iter=args.num_iter
+    )
+    # cpu time of this rank, its wall time if it had a core of its own
+    elapsed, cpu = time.time() - start, time.process_time() - cpu_start
+    # halo exchange alone, without waiting for the denoiser of the other ranks
+    plan = HaloPlan(adj, rank, world_size)
+    buffer = torch.randn((len(plan.elements), 804, 3))
+    dist.barrier()
+    halo_start = time.time()
+    for _ in range(args.halo_repeat):
+        halo_exchange(buffer, plan)
+    cost = torch.tensor([cpu, (time.time() - halo_start) / args.halo_repeat])
+    gathered = [torch.empty_like(cost) for _ in range(world_size)]
+    dist.all_gather(gathered, cost)
+    # cpu time and halo exchange of the slowest rank
+    if rank == 0:
+        queue.put((elapsed, torch.stack(gathered).max(dim=0).values.tolist()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="scaling benchmark of distributed multi element composition")
+    parser.add_argument("--max_workers", default=4, type=int, help="benchmark 1 to max_workers local workers")
+    parser.add_argument(
+        "--n_copy",
+        default="1,4",
+        type=lambda s: [int(item) for item in s.split(",")],
+        help="copies of the 64 element assembly, benchmark each",
+    )
+    parser.add_argument("--diffusion_step", default=250, type=int, help="diffusion_step")
+    parser.add_argument("--ddim_step", default=10, type=int, help="ddim sampling step")
+    parser.add_argument("--num_iter", default=2, type=int, help="outer iteration")
+    parser.add_argument("--n_layer", default=5, type=int, help="layers")
+    parser.add_argument("--hidden_dim", default=64, type=int, help="hidden dim")
+    parser.add_argument("--threads", default=1, type=int, help="torch threads per worker")
+    parser.add_argument("--halo_repeat", default=100, type=int, help="halo exchanges timed alone")
+    parser.add_argument("--port", default=29500, type=int, help="port of the process group")
+    parser.add_argument("--seed", default=42, type=int, help="random seed")
+    args = parser.parse_args()
+
+    # time: wall time; cpu: cpu time of the slowest rank, the wall time when each worker has its own cores (time
+    # overstates it when workers * threads exceeds the cores), speedup and efficiency are of cpu; halo: wall time of
+    # one halo exchange alone, against step: cpu time of one sampling step of the slowest rank
+    ctx = mp.get_context("spawn")
+    steps = args.num_iter * args.ddim_step
+    for n_copy in args.n_copy:
+        base = None
+        for world_size in range(1, args.max_workers + 1):
+            queue = ctx.SimpleQueue()
+            run_distributed(world_size, benchmark_worker, args, n_copy, queue, port=args.port + world_size)
+            elapsed, (cpu, halo) = queue.get()
+            base = cpu if base is None else base
+            print(
+                f"workers: {world_size}, elements: {64 * n_copy}, time: {elapsed:.2f}s, cpu: {cpu:.2f}s, "
+                f"speedup: {base / cpu:.2f}, efficiency: {base / cpu / world_size:.2f}, "
+                f"halo: {halo * 1000:.2f}ms, step: {cpu / steps * 1000:.1f}ms"
+            )
@@ -0,0 +1,133 @@
+import numpy as np
+import torch
+
+
+# boundary of the 64 element validation assembly (val.i)
+left = "sym"
+right = "free"
+bottom = "sym"
+# neighbor of each element in the 64 element validation assembly, int is a neighboring element
+neighbors = {
+    # 1
+    1: (left, right, 11),
+    2: (left, 11, 12),
+    3: (11, right, 13),
+    4: (left, 12, 14),
+    5: (12, 13, 15),
+    6: (13, right, 16),
+    7: (left, 14, 26),
+    8: (14, 15, 25),
+    9: (15, 16, 24),
+    10: (16, right, 23),
+    11: (3, 2, 1),
+    12: (5, 4, 2),
+    13: (6, 5, 3),
+    14: (8, 7, 4),
+    15: (9, 8, 5),
+    16: (10, 9, 6),
+    17: (55, 42, 27),
+    18: (52, 27, 28),
+    19: (27, 38, 29),
+    20: (50, 28, 30),
+    21: (28, 29, 31),
+    22: (29, 35, 32),
+    23: (49, 30, 10),
+    24: (30, 31, 9),
+    25: (31, 32, 8),
+    26: (32, 33, 7),
+    27: (19, 18, 17),
+    28: (21, 20, 18),
+    29: (22, 21, 19),
+    30: (24, 23, 20),
+    31: (25, 24, 21),
+    32: (26, 25, 22),
+    33: (left, 26, 43),
+    34: (left, 43, 44),
+    35: (43, 22, 45),
+    36: (left, 44, 46),
+    37: (44, 45, 47),
+    38: (45, 19, 48),
+    39: (left, 46, bottom),
+    40: (46, 47, bottom),
+    41: (47, 48, bottom),
+    42: (48, 17, bottom),
+    43: (35, 34, 33),
+    44: (37, 36, 34),
+    45: (38, 37, 35),
+    46: (40, 39, 36),
+    47: (41, 40, 37),
+    48: (42, 41, 38),
+    49: (23, right, 59),
+    50: (20, 59, 60),
+    51: (59, right, 61),
+    52: (18, 60, 62),
+    53: (60, 61, 63),
+    54: (61, right, 64),
+    55: (17, 62, bottom),
+    56: (62, 63, bottom),
+    57: (63, 64, bottom),
+    58: (64, right, bottom),
+    59: (51, 50, 49),
+    60: (53, 52, 50),
+    61: (54, 53, 51),
+    62: (56, 55, 52),
+    63: (57, 56, 53),
+    64: (58, 57, 54),
+}
+
+
+def boundary_emb_f(b_type, n_nods=804):
+    free_emb = np.array([0, 0, 0])  # np.ones((1, 8)) * -1
+    sym_emb = np.array([0, 1, 1])  # np.ones((1, 8)) * -2
+    if b_type == "sym":
+        return np.tile(sym_emb, (n_nods, 1))
+    elif b_type == "free":
+        return np.tile(free_emb, (n_nods, 1))
+
+
+def tile_assembly(adj, n_copy):
+    """n_copy disjoint copies of an assembly, used to benchmark large assemblies"""
+    n_element = len(adj)
+    adj_tiled = {}
+    for c in range(n_copy):
+        for e, neighbor_e in adj.items():
+            adj_tiled[e + c * n_element] = tuple(
+                neighbor + c * n_element if isinstance(neighbor, int) else neighbor for neighbor in neighbor_e
+            )
+    return adj_tiled
+
+
+def update(
+    alpha,
+    adj,
+    cond_shape,
+    boundary_emb,
+    mult_e_estimate,
+    mult_e_estimate_before,
+    other_condition,
+    normalize=None,
+    renormalize=None,
+):
+    """update function of heatpipe for compose_diffusion_multiE*, adj is a CompiledAdjacency.
+
+    other_condition: coord (b, n_node, 2), flux (b,)
+    """
+    coord, flux = other_condition[0], other_condition[1]
+    weight_field = mult_e_estimate_before * (1 - alpha) + mult_e_estimate * alpha
+    return (coord, adj.assemble(weight_field, flux))
+
+
+def coarse_estimate(model, x, edge_index, n_node=804):
+    """initial guess of every element from a coarse model of the whole assembly, the GIN over the element graph (one
+    node per element) trained by src/train/heatpipe_gnn.py on the *_element_as_one_node.npy data. Elements are in the
+    order of neighbors.
+
+    Args:
+        model: GIN over the element graph.
+        x (Tensor): feature of each element, shape: n_element, 4
+        edge_index (Tensor): element graph, shape: 2, n_edge
+    Returns:
+        Tensor: shape: n_element, n_node, 3
+    """
+    batch = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+    return model(x=x, edge_index=edge_index, batch=batch).reshape(x.shape[0], n_node, -1)
@@ -0,0 +1,16 @@
+from scipy.spatial import cKDTree
+
+
+def nearest_nodes(coord_src, coord_dst, k=1):
+    """k nearest nodes of coord_src to each node of coord_dst, with a kd-tree instead of a search over all pairs
+
+    Args:
+        coord_src (np.ndarray): shape: n_src, 2
+        coord_dst (np.ndarray): shape: n_dst, 2
+        k (int, optional): Defaults to 1.
+    Returns:
+        np.ndarray: distances, shape: n_dst (k == 1) or n_dst, k
+        np.ndarray: index in coord_src, shape: n_dst (k == 1) or n_dst, k
+    """
+    return cKDTree(coord_src).query(coord_dst, k=k)
+
@@ -0,0 +1,35 @@
+import torch
+
+
+def k(t):
+    return 17.5 * (1 - 0.223) / (1 + 0.161) + 1.54e-2 * (1 + 0.0061) / (1 + 0.161) * t + 9.38e-6 * t * t
+
+
+def update_neu(alpha, mult_p_estimate, mult_p_estimate_before, other_condition, normalize, renormalize):
+    weight_field = []
+    for i in range(len(mult_p_estimate)):
+        weight_field.append(alpha * mult_p_estimate[i] + (1 - alpha) * mult_p_estimate_before[i])
+    T_n = torch.concat((weight_field[1], weight_field[2][:, 0:1]), dim=-1)
+    (phi_bc,) = other_condition
+    cond = [phi_bc, T_n]
+    return cond
+
+
+def update_fuel(alpha, mult_p_estimate, mult_p_estimate_before, other_condition, normalize, renormalize):
+    weight_field = []
+    for i in range(len(mult_p_estimate)):
+        weight_field.append(alpha * mult_p_estimate[i] + (1 - alpha) * mult_p_estimate_before[i])
+    neu = weight_field[0][..., :8]
+    fluid_b = weight_field[2][:, 0:1, :, :, 0:1]
+    cond = [neu, fluid_b]
+    return cond
+
+
+def update_fluid(alpha, mult_p_estimate, mult_p_estimate_before, other_condition, normalize, renormalize):
+    weight_field = []
+    for i in range(len(mult_p_estimate)):
+        weight_field.append(alpha * mult_p_estimate[i] + (1 - alpha) * mult_p_estimate_before[i])
+    fuel = renormalize(weight_field[1], field="solid")
+    flux = normalize((fuel[..., -2:-1] - fuel[..., -1:None]) * k(fuel[..., -1:None]), field="flux")
+    cond = [flux]
+    return cond
@@ -0,0 +1,190 @@
+import argparse
+import numpy as np
+import torch
+import sys, os
+from torch_geometric.nn import GIN
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from filepath import ABSOLUTE_PATH
+
+sys.path.append(ABSOLUTE_PATH)
+from src.inference.compose import (
+    Anderson,
+    Telemetry,
+    compose_diffusion_ddim_stream,
+    compose_diffusion_multiE_ddim_stream,
+)
+from src.inference.adjacency import CompiledAdjacency
+from src.inference.heatpipe import neighbors, boundary_emb_f, update, coarse_estimate
+from src.inference.nuclear_thermal import update_neu, update_fuel, update_fluid
+from src.model.diffusion import GaussianDiffusion
+from src.model.transolver import Transolver
+from src.model.video_diffusion_pytorch_conv3d import Unet3D_with_Conv3D
+from src.train.checkpoint import load_checkpoint
+from src.train.nuclear_thermal_coupling import cond_emb, normalize, renormalize
+from src.utils.utils import set_seed
+
+
+def count_iterations(stream, n_sample):
+    """run a compose stream to the end
+
+    Returns:
+        int: outer iterations until every sample stopped
+        float: outer iterations per sample on average
+    """
+    n_iter, sample_iter = 0, 0
+    for state in stream:
+        if state.step is None:
+            n_iter = state.k + 1
+            sample_iter += n_sample if state.index is None else len(state.index)
+    return n_iter, sample_iter / n_sample
+
+
+def ntcouple(args, device):
+    """NTcouple validation composition of the trained Unet diffusion models (nuclear_thermal.ipynb)"""
+    folder = os.path.join(ABSOLUTE_PATH, "data/NTcouple/val")
+    fields = [
+        torch.tensor(np.load(os.path.join(folder, name + ".npy"))).float().to(device)[: args.n_sample]
+        for name in ["neu", "fuel", "fluid"]
+    ]
+    bc = normalize(torch.tensor(np.load(os.path.join(folder, "bc.npy"))).float().to(device)[: args.n_sample], "neutron")
+    model_list = []
+    for train_which, dim, field in zip(["neutron", "solid", "fluid"], [8, 8, 16], fields):
+        emb = cond_emb(train_which, device=device)
+        model = Unet3D_with_Conv3D(
+            dim=dim,
+            cond_dim=len(emb),
+            out_dim=field.shape[1],
+            cond_emb=emb,
+            dim_mults=(1, 2, 4),
+            use_sparse_linear_attn=False,
+            attn_dim_head=16,
+        ).to(device)
+        diffusion = GaussianDiffusion(
+            model,
+            seq_length=tuple(field.shape[1:]),
+            timesteps=args.diffusion_step,
+            sampling_timesteps=args.ddim_step,
+            auto_normalize=False,
+            ddim_sampling_eta=0,
+        ).to(device)
+        path = os.path.join(
+            ABSOLUTE_PATH, "results/nuclear_thermal_coupling", "diffusionUnet" + train_which, "iter1_5000/model.pt"
+        )
+        diffusion.load_state_dict(torch.load(path)["model"], strict=False)
+        model_list.append(diffusion)
+
+    def stream(anderson, coarse=False, telemetry=None):
+        return compose_diffusion_ddim_stream(
+            model_list,
+            [field.shape for field in fields],
+            [update_neu, update_fuel, update_fluid],
+            normalize,
+            renormalize,
+            other_condition=[bc],
+            num_iter=args.max_iter,
+            tol=args.tol,
+            restart_t=args.restart_t,
+            anderson=anderson,
+            telemetry=telemetry,
+        )
+
+    return stream, bc.shape[0]
+
+
+def heatpipe(args, device):
+    """64 element heatpipe validation composition of the trained Transolver diffusion model (heatpipe_ablation.ipynb)"""
+    model = Transolver(
+        space_dim=2,
+        n_layers=5,
+        n_hidden=64,
+        dropout=0.0,
+        n_head=8,
+        Time_Input=True,
+        act="gelu",
+        mlp_ratio=1,
+        fun_dim=13,
+        out_dim=3,
+        slice_num=16,
+        ref=8,
+        unified_pos=False,
+    ).to(device)
+    diffusion = GaussianDiffusion(
+        model,
+        seq_length=tuple([804, 3]),
+        timesteps=args.diffusion_step,
+        sampling_timesteps=args.ddim_step,
+        auto_normalize=False,
+    ).to(device)
+    diffusion.load_state_dict(
+        torch.load(os.path.join(ABSOLUTE_PATH, "results/heatpipe/diffusion/transformer/model.pt"))["model"]
+    )
+    coord = torch.tensor(np.load(ABSOLUTE_PATH + "/data/heatpipe/coord.npy")).to(device).float()
+    coord[:, 0] = (coord[:, 0] - 0.0455) / (0.065345 - 0.0455) * 2 - 1
+    coord[:, 1] = (coord[:, 1] - 0.072) / (0.08918 - 0.072) * 2 - 1
+    coord = coord.expand(64, -1, -1)
+    flux = torch.tensor(np.load(ABSOLUTE_PATH + "/data/heatpipe/val_flux.npy")).to(device)
+    flux = (flux - 1e5) / 9e5 * 2 - 1
+    adj = CompiledAdjacency(neighbors, boundary_emb_f, device=device)
+    init_estimate = None
+    if args.coarse_model is not None:
+        gin = GIN(in_channels=4, hidden_channels=args.coarse_hidden, out_channels=2412, num_layers=args.coarse_layer)
+        gin.load_state_dict(load_checkpoint(args.coarse_model, map_location=device)["model"])
+        x = torch.tensor(np.load(ABSOLUTE_PATH + "/data/heatpipe/x_val_element_as_one_node.npy")).to(device).float()
+        edge_index = np.load(ABSOLUTE_PATH + "/data/heatpipe/adj_val_element_as_one_node.npy").transpose(1, 0)
+        with torch.no_grad():
+            init_estimate = coarse_estimate(gin.to(device), x, torch.tensor(edge_index).long().to(device))
+
+    def stream(anderson, coarse=False, telemetry=None):
+        return compose_diffusion_multiE_ddim_stream(
+            diffusion,
+            (804, 3),
+            10,
+            update,
+            adj,
+            boundary_emb_f,
+            other_condition=[coord, flux],
+            num_iter=args.max_iter,
+            device=device,
+            tol=args.tol,
+            restart_t=args.restart_t,
+            anderson=anderson,
+            init_estimate=init_estimate if coarse else None,
+            telemetry=telemetry,
+        )
+
+    return stream, 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="outer iterations of composition with and without Anderson")
+    parser.add_argument("--case", default="ntcouple", type=str, help="ntcouple or heatpipe")
+    parser.add_argument("--tol", default=1e-3, type=float, help="tolerance of relative change of the estimates")
+    parser.add_argument("--max_iter", default=20, type=int, help="maximum outer iteration")
+    parser.add_argument("--m", default="1,3", type=lambda s: [int(item) for item in s.split(",")], help="Anderson m")
+    parser.add_argument("--n_sample", default=None, type=int, help="NTcouple validation samples, all by default")
+    parser.add_argument("--diffusion_step", default=250, type=int, help="diffusion_step")
+    parser.add_argument("--ddim_step", default=25, type=int, help="ddim sampling step")
+    parser.add_argument("--restart_t", default=None, type=int, help="warm restart timestep of outer iterations")
+    parser.add_argument("--coarse_model", default=None, type=str, help="heatpipe GIN checkpoint, also run two-level")
+    parser.add_argument("--coarse_hidden", default=3600, type=int, help="hidden dim of the GIN")
+    parser.add_argument("--coarse_layer", default=4, type=int, help="layers of the GIN")
+    parser.add_argument("--telemetry", default=None, type=str, help="save telemetry of each run to this folder")
+    parser.add_argument("--seed", default=42, type=int, help="random seed")
+    args = parser.parse_args()
+
+    device = "cuda"
+    stream, n_sample = ntcouple(args, device) if args.case == "ntcouple" else heatpipe(args, device)
+    levels = [False, True] if args.case == "heatpipe" and args.coarse_model is not None else [False]
+    for coarse in levels:
+        for m in [0] + args.m:
+            set_seed(args.seed)
+            telemetry = Telemetry() if args.telemetry is not None else None
+            n_iter, mean_iter = count_iterations(stream(Anderson(m) if m > 0 else None, coarse, telemetry), n_sample)
+            name = ("two-level " if coarse else "") + ("plain" if m == 0 else "anderson m=" + str(m))
+            print(f"{args.case} {name}: outer iterations: {n_iter}, per sample: {mean_iter:.2f}")
+            if telemetry is not None:
+                os.makedirs(args.telemetry, exist_ok=True)
+                file = os.path.join(args.telemetry, args.case + "_" + name.replace(" ", "_").replace("=", ""))
+                telemetry.save_json(file + ".json")
+                telemetry.save_chrome_trace(file + "_trace.json")
@@ -260,6 +260,8 @@ class GaussianDiffusion(Module):
         assert self.sampling_timesteps <= timesteps
         self.is_ddim_sampling = self.sampling_timesteps < timesteps
         self.ddim_sampling_eta = ddim_sampling_eta
+        # generator of the sampling noise, None for the global RNG (set e.g. by background validation)
+        self.generator = None
 
         # helper function to register buffer from float64 to float32
 
@@ -368,6 +370,9 @@ class GaussianDiffusion(Module):
 
         return ModelPrediction(pred_noise, x_start)
 
+    def randn(self, shape, device):
+        return torch.randn(shape, device=device, generator=self.generator)
+
     def p_mean_variance(self, x, t, cond, x_self_cond=None, clip_denoised=True):
         preds = self.model_predictions(x, t, cond, x_self_cond)
         x_start = preds.pred_x_start
@@ -385,7 +390,7 @@ class GaussianDiffusion(Module):
         model_mean, _, model_log_variance, x_start = self.p_mean_variance(
             x=x, t=batched_times, cond=cond, x_self_cond=x_self_cond, clip_denoised=clip_denoised
         )
-        noise = torch.randn_like(x) if t > 0 else 0.0  # no noise if t == 0
+        noise = self.randn(x.shape, x.device) if t > 0 else 0.0  # no noise if t == 0
         pred_img = model_mean + (0.5 * model_log_variance).exp() * noise
         return pred_img, x_start
 
@@ -393,7 +398,7 @@ class GaussianDiffusion(Module):
     def p_sample_loop(self, shape, cond):
         batch, device = shape[0], self.betas.device
 
-        img = torch.randn(shape, device=device)
+        img = self.randn(shape, device)
 
         x_start = None
 
@@ -421,7 +426,7 @@ class GaussianDiffusion(Module):
         times = list(reversed(times.int().tolist()))
         time_pairs = list(zip(times[:-1], times[1:]))  # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
 
-        img = torch.randn(shape, device=device)
+        img = self.randn(shape, device)
 
         x_start = None
 
@@ -442,7 +447,7 @@ class GaussianDiffusion(Module):
             sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
             c = (1 - alpha_next - sigma**2).sqrt()
 
-            noise = torch.randn_like(img)
+            noise = self.randn(img.shape, device)
 
             img = x_start * alpha_next.sqrt() + c * pred_noise + sigma * noise
 
@@ -0,0 +1,201 @@
+import os
+import random
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import torch
+from safetensors.torch import save_file, load_file
+
+
+def to_cpu(state):
+    """copy of a (nested dict / list / tuple of) state with every tensor copied to cpu"""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return state
+
+
+def rng_state():
+    """states of the python, numpy, torch and cuda random number generators"""
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"].cpu())
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+
+def latest_milestone(folder):
+    """largest milestone of the model-{milestone}.pt checkpoints in folder, None if there is none"""
+    milestones = [int(m.group(1)) for m in (re.fullmatch(r"model-(\d+)\.pt", f) for f in os.listdir(folder)) if m]
+    return max(milestones, default=None)
+
+
+def load_checkpoint(path, map_location=None):
+    """checkpoint written by CheckpointWriter, with the weights of a safetensors checkpoint merged back
+
+    Args:
+        path (str): model-{milestone}.pt
+    Returns:
+        dict: step, model, opt, ema, scaler, version, ...
+    """
+    # the python and numpy RNG states are not tensors
+    data = torch.load(str(path), map_location=map_location, weights_only=False)
+    weights = Path(path).with_suffix(".safetensors")
+    if "model" not in data and weights.exists():
+        tensors = load_file(str(weights), device=str(map_location) if map_location is not None else "cpu")
+        for key in ["model", "ema"]:
+            data[key] = {name[len(key) + 1 :]: t for name, t in tensors.items() if name.startswith(key + ".")}
+    # the online model of the EMA is the model, written once
+    if "ema" in data and not any(name.startswith("online_model.") for name in data["ema"]):
+        data["ema"].update({"online_model." + name: t for name, t in data["model"].items()})
+    return data
+
+
+def load_record(folder, milestone, record):
+    """validation record of the checkpoints up to milestone. record.npy in folder is rewritten when a validation
+    finishes after its checkpoint was saved (see Validation), so it is preferred to the record of the checkpoint.
+
+    Args:
+        folder (str): results folder.
+        milestone (int): checkpoint loaded.
+        record (list): record of the checkpoint, [milestone, train loss, validation loss] per checkpoint.
+    Returns:
+        list: [milestone, train loss, validation loss] per checkpoint
+    """
+    path = Path(folder) / "record.npy"
+    if not path.exists():
+        return [list(r) for r in record]
+    return [[int(r[0])] + r[1:] for r in np.load(str(path)).tolist() if r[0] <= milestone]
+
+
+class CheckpointWriter(object):
+    """writes the checkpoints of Trainer on a background thread, keeping the best checkpoints by validation loss.
+
+    The state is copied to cpu on the calling thread, so training goes on while it is written. Writes go through a
+    temporary file, so an interrupted write never leaves a broken checkpoint. With safetensors, the model and EMA
+    weights are written to model-{milestone}.safetensors (loaded memory-mapped) and the rest to model-{milestone}.pt.
+    """
+
+    def __init__(self, folder, keep_best=None, safetensors=False, asynchronous=True):
+        """
+        Args:
+            folder (str): results folder.
+            keep_best (int, optional): keep the keep_best checkpoints of lowest validation loss and the latest one,
+                delete the others. Defaults to None, i.e. keep every checkpoint.
+            safetensors (bool, optional): write the weights in safetensors format. Defaults to False.
+            asynchronous (bool, optional): write on a background thread. Defaults to True.
+        """
+        self.folder = Path(folder)
+        self.keep_best = keep_best
+        self.safetensors = safetensors
+        self.pool = ThreadPoolExecutor(1, thread_name_prefix="checkpoint") if asynchronous else None
+        # writes and rescores not yet waited for, score is also called from the validation thread. The lock guards
+        # pending, and scores, latest, record.npy and pruning, changed by the writer and validation threads
+        self.pending = []
+        self.lock = threading.Lock()
+        # validation loss of the checkpoints kept, by milestone, and the latest milestone written
+        self.scores = {}
+        self.latest = None
+
+    def files(self, milestone):
+        path = self.folder / f"model-{milestone}.pt"
+        return [path, path.with_suffix(".safetensors")]
+
+    def save(self, milestone, state, loss=None, record=None):
+        """
+        Args:
+            milestone (int): checkpoint number.
+            state (dict): step, model, opt, ema, scaler, version, ...
+            loss (float, optional): validation loss of the checkpoint, used to keep the best. Defaults to None.
+            record (list, optional): written to record.npy. Defaults to None.
+        """
+        record = np.array(record) if record is not None else None
+        if "ema" in state:
+            # the online model of the EMA shares its tensors with the model, which safetensors refuses
+            state = dict(state)
+            state["ema"] = {name: t for name, t in state["ema"].items() if not name.startswith("online_model.")}
+        if self.pool is None:
+            self.write(milestone, state, loss, record)
+            return
+        state = to_cpu(state)
+        # one write at a time, also raises the error of the previous write
+        self.wait()
+        self.submit(self.write, milestone, state, loss, record)
+
+    def submit(self, fn, *args):
+        with self.lock:
+            self.pending.append(self.pool.submit(fn, *args))
+
+    def write(self, milestone, state, loss, record):
+        path, weights = self.files(milestone)
+        if self.safetensors:
+            state = dict(state)
+            tensors = {}
+            for key in ["model", "ema"]:
+                tensors.update({key + "." + name: t.contiguous() for name, t in state.pop(key).items()})
+            save_file(tensors, str(weights) + ".tmp")
+            os.replace(str(weights) + ".tmp", weights)
+        torch.save(state, str(path) + ".tmp")
+        os.replace(str(path) + ".tmp", path)
+        with self.lock:
+            if record is not None:
+                np.save(str(self.folder / "record.npy"), record)
+            self.latest = milestone
+            if loss is not None:
+                self.scores[milestone] = loss
+            self.prune()
+
+    def score(self, milestone, loss, record=None):
+        """set the validation loss of a checkpoint saved before, e.g. by background validation"""
+        record = np.array(record) if record is not None else None
+        if self.pool is None:
+            self.rescore(milestone, loss, record)
+            return
+        # after the pending write of the checkpoint, on the writer thread
+        self.submit(self.rescore, milestone, loss, record)
+
+    def rescore(self, milestone, loss, record):
+        with self.lock:
+            if record is not None:
+                np.save(str(self.folder / "record.npy"), record)
+            self.scores[milestone] = loss
+            self.prune()
+
+    def prune(self):
+        """delete the checkpoints but the keep_best best and the latest, with self.lock held"""
+        if self.keep_best is None:
+            return
+        best = sorted(self.scores, key=self.scores.get)[: self.keep_best]
+        for milestone in list(self.scores):
+            if milestone not in best and milestone != self.latest:
+                for file in self.files(milestone):
+                    if file.exists():
+                        file.unlink()
+                del self.scores[milestone]
+
+    def wait(self):
+        """block until the pending writes and rescores are done, and raise the first error of them"""
+        with self.lock:
+            pending, self.pending = self.pending, []
+        error = None
+        for future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
@@ -0,0 +1,286 @@
+import argparse
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, TensorDataset
+
+
+class MemmapArray(object):
+    """rows of .npy arrays read lazily through np.load(mmap_mode="r"), for data larger than memory.
+
+    Only the rows sampled are read, in increasing order, converted to tensors and transformed (e.g. normalized). The
+    order of the rows changes each epoch, so caching the rows read would rarely pay off.
+    """
+
+    def __init__(self, paths, transform=None, start=0, stop=None):
+        """
+        Args:
+            paths (str or list): .npy file, or files with the same number of rows passed together to transform.
+            transform (callable, optional): maps the float tensors of rows of each file to the rows of this array
+                row by row, e.g. normalize. Defaults to None, i.e. the rows of the single file.
+            start (int, optional): first row. Defaults to 0.
+            stop (int, optional): end row, e.g. n_dataset. Defaults to None, i.e. all rows.
+        """
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self.arrays = [np.load(path, mmap_mode="r") for path in self.paths]
+        self.transform = transform
+        n = self.arrays[0].shape[0]
+        self.start = start
+        self.stop = min(stop, n) if stop is not None else n
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def shape(self):
+        return (len(self),) + tuple(self[[0]].shape[1:])
+
+    def subset(self, start=None, stop=None):
+        """rows start:stop of this array (python slice semantics)"""
+        start, stop, _ = slice(start, stop).indices(len(self))
+        return MemmapArray(self.paths, self.transform, self.start + start, self.start + stop)
+
+    def __getitem__(self, index):
+        """rows of index (int tensor or array, relative to start), on cpu"""
+        index = torch.as_tensor(index).long().cpu()
+        # each row once and in file order, so that the reads run forward through the file
+        unique, inverse = torch.unique(index, sorted=True, return_inverse=True)
+        file_index = (unique + self.start).numpy()
+        rows = [torch.from_numpy(array[file_index]).float() for array in self.arrays]
+        rows = self.transform(*rows) if self.transform is not None else rows[0]
+        return rows[inverse]
+
+
+class MemmapDataset(Dataset):
+    """dataset of MemmapArrays with the same number of rows, a disk-backed counterpart of TensorDataset"""
+
+    def __init__(self, *arrays):
+        assert all(len(a) == len(arrays[0]) for a in arrays), "size mismatch between arrays"
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays[0])
+
+    def __getitem__(self, i):
+        return tuple(rows[0] for rows in self.rows(torch.tensor([i])))
+
+    def rows(self, index):
+        """batch of rows of index of each array, on cpu"""
+        return [a[index] for a in self.arrays]
+
+    def subset(self, start=None, stop=None):
+        return MemmapDataset(*[a.subset(start, stop) for a in self.arrays])
+
+
+class TensorBatchLoader(object):
+    """batches of in-memory tensors, used in place of DataLoader(TensorDataset(...), shuffle=True).
+
+    DataLoader indexes the dataset sample by sample and collates the samples with torch.stack each step. Here one
+    permutation is drawn per epoch and each batch is sliced with one index_select per tensor, on the device of the
+    tensor. Iterating yields a list with a batch of each tensor, like DataLoader over a TensorDataset.
+    A MemmapDataset is read batch-wise the same way. Batches are moved to device, like those of a DataLoader
+    prepared by Accelerator.
+
+    The permutation of epoch e is drawn from seed + e, so the data order can be restored from the number of batches
+    read (set_position), e.g. when training resumes from a checkpoint.
+    """
+
+    def __init__(
+        self, dataset, batch_size=1, shuffle=False, drop_last=False, seed=None, rank=0, world_size=1, device=None
+    ):
+        """
+        Args:
+            dataset (TensorDataset, MemmapDataset or list): tensors with the same first dimension.
+            batch_size (int, optional): Defaults to 1.
+            shuffle (bool, optional): draw a new permutation each epoch. Defaults to False.
+            drop_last (bool, optional): drop the last incomplete batch. Defaults to False.
+            seed (int, optional): seed of the permutation of the first epoch. Defaults to None, i.e.
+                torch.initial_seed(), the same on every process seeded with set_seed.
+            rank (int, optional): with world_size > 1, each batch is split over the processes (split_batches of
+                Accelerator) and this process takes rows rank::world_size of it. Defaults to 0.
+            world_size (int, optional): number of processes. Defaults to 1.
+            device (str, optional): device of the batches. Defaults to None, i.e. that of the tensors (cpu for a
+                MemmapDataset).
+        """
+        if isinstance(dataset, MemmapDataset):
+            self.tensors = list(dataset.arrays)
+        else:
+            self.tensors = list(dataset.tensors if isinstance(dataset, TensorDataset) else dataset)
+        assert all(len(t) == len(self.tensors[0]) for t in self.tensors), "size mismatch between tensors"
+        self.dataset = dataset
+        self.device = device
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rank, self.world_size = rank, world_size
+        self.seed = seed if seed is not None else torch.initial_seed()
+        # epoch of the next iteration and batches of it already read
+        self.epoch, self.skip = 0, 0
+
+    def __len__(self):
+        n = len(self.tensors[0])
+        return n // self.batch_size if self.drop_last else (n + self.batch_size - 1) // self.batch_size
+
+    def set_position(self, n_batch):
+        """continue after n_batch batches read since the first epoch"""
+        self.epoch, self.skip = divmod(n_batch, len(self))
+
+    def order(self):
+        """permutation of the next epoch and the batches of it to skip"""
+        epoch, skip = self.epoch, self.skip
+        self.epoch, self.skip = epoch + 1, 0
+        n = len(self.tensors[0])
+        if not self.shuffle:
+            return torch.arange(n), skip
+        return torch.randperm(n, generator=torch.Generator().manual_seed(self.seed + epoch)), skip
+
+    def indices(self):
+        """cpu row index of each batch of an epoch (rows of this process), with the permutation of the epoch"""
+        order, skip = self.order()
+        for i in range(skip, len(self)):
+            yield order[i * self.batch_size : (i + 1) * self.batch_size][self.rank :: self.world_size]
+
+    def to_device(self, batch):
+        if self.device is None:
+            return batch
+        return [b.to(self.device, non_blocking=True) for b in batch]
+
+    def read(self, index):
+        """batch of the rows of index of each tensor"""
+        if isinstance(self.dataset, MemmapDataset):
+            return self.to_device(self.dataset.rows(index))
+        return self.to_device([t.index_select(0, index.to(t.device)) for t in self.tensors])
+
+    def __iter__(self):
+        if isinstance(self.dataset, MemmapDataset):
+            for index in self.indices():
+                yield self.read(index)
+            return
+        order, skip = self.order()
+        order = {t.device: order.to(t.device) for t in self.tensors}
+        for i in range(skip, len(self)):
+            sl = slice(i * self.batch_size, (i + 1) * self.batch_size)
+            yield self.to_device(
+                [t.index_select(0, order[t.device][sl][self.rank :: self.world_size]) for t in self.tensors]
+            )
+
+
+class Prefetcher(object):
+    """endless iterator over the batches of loader (cycling over epochs, like cycle in train.py), reading the next
+    depth batches on n_thread background threads so that reading overlaps with training.
+
+    Batches of a TensorBatchLoader are read in parallel (its read, including the normalization of a MemmapDataset,
+    runs on the threads) and come in order; other loaders are iterated on the threads one batch at a time. Cpu
+    batches are staged in pinned memory and copied to device without blocking.
+    """
+
+    def __init__(self, loader, depth=4, n_thread=2, device=None, pin_memory=True):
+        """
+        Args:
+            loader (iterable): TensorBatchLoader, DataLoader or any iterable of lists of tensors.
+            depth (int, optional): batches read ahead. Defaults to 4.
+            n_thread (int, optional): reading threads. Defaults to 2.
+            device (str, optional): device the batches are moved to. Defaults to None, i.e. kept as read.
+            pin_memory (bool, optional): pin cpu batches when cuda is available. Defaults to True.
+        """
+        self.loader = loader
+        self.depth = depth
+        self.device = device
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.pool = ThreadPoolExecutor(n_thread, thread_name_prefix="prefetch")
+        self.lock = threading.Lock()
+        self.iterator = None
+        self.source = self.tasks()
+        self.pending = deque()
+        # metrics: batches served, seconds waited for a batch, batches ready when one was requested
+        self.n_batch, self.stall, self.ready = 0, 0.0, 0
+
+    def tasks(self):
+        """endless sequence of functions reading one batch each"""
+        while True:
+            if isinstance(self.loader, TensorBatchLoader):
+                for index in self.loader.indices():
+                    yield lambda index=index: self.stage(self.loader.read(index))
+            else:
+                yield lambda: self.stage(self.next_batch())
+
+    def next_batch(self):
+        with self.lock:
+            if self.iterator is None:
+                self.iterator = iter(self.loader)
+            try:
+                return next(self.iterator)
+            except StopIteration:
+                self.iterator = iter(self.loader)
+                return next(self.iterator)
+
+    def stage(self, batch):
+        if self.pin_memory:
+            batch = [b.pin_memory() if isinstance(b, torch.Tensor) and not b.is_cuda else b for b in batch]
+        return batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while len(self.pending) < self.depth:
+            self.pending.append(self.pool.submit(next(self.source)))
+        future = self.pending.popleft()
+        self.ready += future.done() + sum(f.done() for f in self.pending)
+        start = time.perf_counter()
+        batch = future.result()
+        self.stall += time.perf_counter() - start
+        self.n_batch += 1
+        self.pending.append(self.pool.submit(next(self.source)))
+        if self.device is not None:
+            batch = [b.to(self.device, non_blocking=True) if isinstance(b, torch.Tensor) else b for b in batch]
+        return batch
+
+    def stats(self):
+        """batches served, total and mean stall time (s) waiting for a batch and mean queue depth (ready batches)"""
+        n = max(self.n_batch, 1)
+        return {
+            "batches": self.n_batch,
+            "stall": self.stall,
+            "stall_per_batch": self.stall / n,
+            "depth": self.ready / n,
+        }
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pool.shutdown(wait=False)
+
+
+def benchmark(loader, n_step):
+    """seconds per batch of n_step batches of loader, cycling over epochs"""
+    step, start = 0, time.time()
+    while step < n_step:
+        for batch in loader:
+            step += 1
+            if step == n_step:
+                break
+    if batch[0].is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / n_step
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark of TensorBatchLoader against DataLoader(TensorDataset)")
+    parser.add_argument("--batchsize", default=256, type=int, help="batch size, 256 in reaction_diffusion.py")
+    parser.add_argument("--n_dataset", default=9000, type=int, help="training samples, --gap of reaction_diffusion.py")
+    parser.add_argument("--n_step", default=500, type=int, help="batches timed")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    # reaction-diffusion v from u (network_dim 2): data b, 1, 10, 20 and cond b, 2, 10, 20
+    data = torch.rand(args.n_dataset, 1, 10, 20, device=device) * 2 - 1
+    cond = torch.rand(args.n_dataset, 2, 10, 20, device=device) * 2 - 1
+    dataset = TensorDataset(data, cond)
+    t_dataloader = benchmark(DataLoader(dataset, batch_size=args.batchsize, shuffle=True), args.n_step)
+    t_tensor = benchmark(TensorBatchLoader(dataset, batch_size=args.batchsize, shuffle=True), args.n_step)
+    print(f"DataLoader: {t_dataloader * 1e3:.3f} ms/batch, TensorBatchLoader: {t_tensor * 1e3:.3f} ms/batch")
+    print(f"speedup: {t_dataloader / t_tensor:.1f}")
@@ -28,10 +28,10 @@ from src.model.GeoFNO import GeoFNO2d as FNO
 from src.model.diffusion import GaussianDiffusion
 from src.utils.utils import create_res, set_seed, get_time, save_config_from_args, get_parameter_net, find_max_min
 import time
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import TensorDataset
 
 
-def load_data(path, batchsize, tag, device, model_type="transformer"):
+def load_data(path, tag, device, model_type="transformer"):
     if model_type == "transformer":
         # def load_data(path, batchsize, tag, device):
         x = torch.tensor(np.load(path + "/data/heatpipe/x.npy")).to(device).float()  # b, 804, 10
@@ -43,9 +43,7 @@ def load_data(path, batchsize, tag, device, model_type="transformer"):
 
         train_dataset = TensorDataset(coord[:tag], x[:tag], y[:tag])
         test_dataset = TensorDataset(coord[tag:], x[tag:], y[tag:])
-        train_loader = DataLoader(train_dataset, batch_size=batchsize, shuffle=True)
-        test_loader = DataLoader(test_dataset, batch_size=batchsize * 10, shuffle=True)
-        return train_loader, test_loader
+        return train_dataset, test_dataset
     elif model_type == "FNO":
         # def load_data(path, batchsize, tag, device):
         x = torch.tensor(np.load(path + "/data/heatpipe/x.npy")).to(device).float()  # b, 804, 10
@@ -60,9 +58,7 @@ def load_data(path, batchsize, tag, device, model_type="transformer"):
 
         train_dataset = TensorDataset(coord[:tag], x[:tag], y[:tag])
         test_dataset = TensorDataset(coord[tag:], x[tag:], y[tag:])
-        train_loader = DataLoader(train_dataset, batch_size=batchsize, shuffle=True)
-        test_loader = DataLoader(test_dataset, batch_size=batchsize * 10, shuffle=True)
-        return train_loader, test_loader
+        return train_dataset, test_dataset
 
 
 def renormalize(x):
@@ -137,6 +133,11 @@ if __name__ == "__main__":
     parser.add_argument("--slice_num", default=16, type=int, help="transolver slice_num")
     parser.add_argument("--num_node", default=804, type=int, help="num_node")
     parser.add_argument("--gradient_accumulate_every", default=2, type=int, help="gradient_accumulate_every")
+    parser.add_argument("--resume", action="store_true", help="resume from the latest checkpoint in the folder")
+    parser.add_argument(
+        "--log_every", default=None, type=int, help="steps between throughput and step-time logs (metrics.csv)"
+    )
+    parser.add_argument("--sync_every", default=1, type=int, help="steps between copies of the training loss to host")
     parser.add_argument("--gap", default=14000, type=int, help="dataset size for train")
     parser.add_argument("--model_type", default="FNO", type=str, help="gnn or transformer or fno")
     parser.add_argument("--paradigm", default="surrogate", type=str, help="diffusion or surrogate")
@@ -156,9 +157,7 @@ if __name__ == "__main__":
         os.makedirs(results_folder)
     save_config_from_args(args, results_folder)
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    trainLoader, testLoader = load_data(
-        path=ABSOLUTE_PATH, batchsize=args.batchsize, tag=args.gap, device=device, model_type=model_type
-    )
+    train_dataset, test_dataset = load_data(path=ABSOLUTE_PATH, tag=args.gap, device=device, model_type=model_type)
     # test_dataset = TensorDataset(data[interval:], cond[interval:])
     train_function, val_function = forward_function(model_type=model_type, paradigm=paradigm)
     if paradigm == "diffusion":
@@ -204,8 +203,8 @@ if __name__ == "__main__":
         get_parameter_net(diffusion)
         train = Trainer(
             model=diffusion,
-            data_train=trainLoader,
-            data_val=testLoader,
+            data_train=train_dataset,
+            data_val=test_dataset,
             train_function=train_function,
             val_function=val_function,
             train_lr=args.lr,
@@ -214,6 +213,9 @@ if __name__ == "__main__":
             save_every=args.checkpoint,
             results_folder=results_folder,
             gradient_accumulate_every=args.gradient_accumulate_every,
+            resume=args.resume,
+            log_every=args.log_every,
+            sync_every=args.sync_every,
         )
 
         train.train()
@@ -247,8 +249,8 @@ if __name__ == "__main__":
         get_parameter_net(model)
         train = Trainer(
             model=model,
-            data_train=trainLoader,
-            data_val=testLoader,
+            data_train=train_dataset,
+            data_val=test_dataset,
             train_function=train_function,
             val_function=val_function,
             train_lr=args.lr,
@@ -257,5 +259,8 @@ if __name__ == "__main__":
             train_batch_size=args.batchsize,
             save_every=args.checkpoint,
             results_folder=results_folder,
+            resume=args.resume,
+            log_every=args.log_every,
+            sync_every=args.sync_every,
         )
         train.train()
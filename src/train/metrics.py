@@ -0,0 +1,107 @@
+import csv
+import os
+import time
+from contextlib import contextmanager, nullcontext
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+PHASES = ["data", "forward", "backward", "optimizer", "ema", "checkpoint"]
+
+
+def batch_samples(batch):
+    """samples in a batch: graphs of a torch_geometric Batch, or rows of a tensor or of the first tensor of a list"""
+    if hasattr(batch, "num_graphs"):
+        return batch.num_graphs
+    if isinstance(batch, torch.Tensor):
+        return batch.shape[0]
+    return batch_samples(batch[0])
+
+
+class TrainMetrics(object):
+    """throughput and step-time breakdown of Trainer, averaged over log_every steps and written to metrics.csv and
+    TensorBoard (tensorboard --logdir results_folder/tensorboard): samples/s, seconds per step in data fetch,
+    forward, backward, optimizer, EMA update and checkpointing (validation and save), and peak cuda memory.
+    Nothing is recorded when log_every is None.
+    """
+
+    def __init__(self, folder, log_every=None, synchronize=True, tensorboard=True):
+        """
+        Args:
+            folder (str): results folder.
+            log_every (int, optional): steps between two logs. Defaults to None, i.e. disabled.
+            synchronize (bool, optional): synchronize cuda at the ends of each phase, so it is charged with its
+                kernels rather than their launch. Defaults to True.
+            tensorboard (bool, optional): also log to TensorBoard. Defaults to True.
+        """
+        self.folder = str(folder)
+        self.log_every = log_every
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.tensorboard = tensorboard
+        self.writer = None
+        self.reset()
+
+    @property
+    def enabled(self):
+        return self.log_every is not None
+
+    def reset(self):
+        self.seconds = {phase: 0.0 for phase in PHASES}
+        self.n_step, self.samples = 0, 0
+        self.start = time.perf_counter()
+
+    def sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def timed(self, phase):
+        self.sync()
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.sync()
+            self.seconds[phase] += time.perf_counter() - begin
+
+    def time(self, phase):
+        """context charging its time to phase"""
+        return self.timed(phase) if self.enabled else nullcontext()
+
+    def step(self, step, samples, loss=None):
+        """count a training step of samples samples, and log every log_every steps"""
+        if not self.enabled:
+            return
+        self.n_step += 1
+        self.samples += samples
+        if step % self.log_every == 0:
+            self.log(step, loss)
+
+    def log(self, step, loss=None):
+        self.sync()
+        elapsed = time.perf_counter() - self.start
+        row = {"step": step, "samples_per_s": self.samples / elapsed, "step_time": elapsed / self.n_step}
+        row.update({phase: seconds / self.n_step for phase, seconds in self.seconds.items()})
+        if torch.cuda.is_available():
+            row["peak_memory_gb"] = torch.cuda.max_memory_allocated() / 1024**3
+            torch.cuda.reset_peak_memory_stats()
+        if loss is not None:
+            row["loss"] = float(loss)
+        path = os.path.join(self.folder, "metrics.csv")
+        new = not os.path.exists(path)
+        with open(path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(row))
+            if new:
+                writer.writeheader()
+            writer.writerow(row)
+        if self.tensorboard:
+            if self.writer is None:
+                self.writer = SummaryWriter(os.path.join(self.folder, "tensorboard"))
+            for key, value in row.items():
+                if key != "step":
+                    self.writer.add_scalar(("time/" if key in PHASES else "train/") + key, value, step)
+            self.writer.flush()
+        self.reset()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
@@ -24,6 +24,8 @@ from filepath import ABSOLUTE_PATH
 sys.path.append(ABSOLUTE_PATH)
 from src.model.diffusion import GaussianDiffusion
 from src.train.train import Trainer
+from src.train.validation import Validation
+from src.train.data import MemmapArray, MemmapDataset
 from src.model.video_diffusion_pytorch_conv3d import Unet3D_with_Conv3D, MLP
 from src.model.fno import FNO3D
 from src.utils.utils import create_res, set_seed, get_time, save_config_from_args, get_parameter_net, find_max_min
@@ -60,6 +62,32 @@ def load_nt_dataset_emb(field="neutron", dataset="iter1", n_data_set=None, devic
     return cond, data
 
 
+def load_nt_dataset_mmap(field="neutron", dataset="iter1", n_data_set=None):
+    """memory-mapped counterpart of load_nt_dataset_emb, rows are read and normalized when sampled (see MemmapArray)"""
+    folder_path = ABSOLUTE_PATH + "/data/NTcouple/" + dataset
+
+    def array(names, transform):
+        paths = [folder_path + "/" + name + ".npy" for name in names]
+        return MemmapArray(paths, transform, stop=n_data_set)
+
+    def fuel_fluid(fuel, fluid):
+        return torch.concat((normalize(fuel, "solid"), normalize(fluid, "fluid")), dim=-1)
+
+    if field == "neutron":
+        cond = [array(["bc_neu"], partial(normalize, field="neutron")), array(["fuel_neu", "fluid_neu"], fuel_fluid)]
+        data = array(["neu"], partial(normalize, field="neutron"))
+    elif field == "solid":
+        cond = [
+            array(["neu_fuel"], partial(normalize, field="neutron")),
+            array(["fluid_fuel"], partial(normalize, field="fluid")),
+        ]
+        data = array(["fuel"], partial(normalize, field="solid"))
+    elif field == "fluid":
+        cond = [array(["fuel_fluid"], partial(normalize, field="flux"))]
+        data = array(["fluid"], partial(normalize, field="fluid"))
+    return cond, data
+
+
 def cond_emb(field="neutron", nx_fuel=8, nx_fluid=12, ny=64, nt=32, hidden=32, device="cuda"):
     def consistent(x):
         return x
@@ -176,6 +204,17 @@ if __name__ == "__main__":
     parser.add_argument("--model_type", default="FNO", type=str, help="Unet or ViT or FNO")
     parser.add_argument("--paradigm", default="diffusion", type=str, help="diffusion or surrogate")
     parser.add_argument("--gradient_accumulate_every", default=2, type=int, help="gradient_accumulate_every")
+    parser.add_argument("--resume", action="store_true", help="resume from the latest checkpoint in the folder")
+    parser.add_argument(
+        "--log_every", default=None, type=int, help="steps between throughput and step-time logs (metrics.csv)"
+    )
+    parser.add_argument("--sync_every", default=1, type=int, help="steps between copies of the training loss to host")
+    parser.add_argument("--mmap", action="store_true", help="read the dataset memory-mapped, for data larger than RAM")
+    parser.add_argument("--prefetch", default=0, type=int, help="batches read ahead on background threads")
+    parser.add_argument("--val_steps", default=None, type=int, help="DDIM steps of validation sampling")
+    parser.add_argument("--val_subset", default=None, type=int, help="validation samples, all by default")
+    parser.add_argument("--val_proxy", action="store_true", help="validate with the denoising loss, no sampling")
+    parser.add_argument("--val_background", action="store_true", help="validate on a background thread")
     # FNO
     parser.add_argument("--fno_nlayer", default=2, type=int, help="fno layers")
     parser.add_argument("--fno_layer_size", default=8, type=int, help="fno_layer_size")
@@ -197,13 +236,19 @@ if __name__ == "__main__":
     save_config_from_args(args, results_folder)
     device = "cuda" if torch.cuda.is_available() else "cpu"
     device = "cuda"
-    cond, data = load_nt_dataset_emb(train_which, args.dataset, args.n_dataset, device=device)
+    if args.mmap:
+        cond, data = load_nt_dataset_mmap(train_which, args.dataset, args.n_dataset)
+    else:
+        cond, data = load_nt_dataset_emb(train_which, args.dataset, args.n_dataset, device=device)
     emb = cond_emb(train_which, device=device)
     interval = -args.gap
 
     image_size = data.shape[-2:]
     frames = data.shape[2]
-    if train_which == "neutron":
+    if args.mmap:
+        train_dataset = MemmapDataset(*[a.subset(None, interval) for a in [data] + cond])
+        data_val = MemmapDataset(*[a.subset(interval, None) for a in [data] + cond])
+    elif train_which == "neutron":
         train_dataset = TensorDataset(data[:interval], cond[0][:interval], cond[1][:interval])
         data_val = TensorDataset(data[interval:], cond[0][interval:], cond[1][interval:])
     elif train_which == "solid":
@@ -213,6 +258,9 @@ if __name__ == "__main__":
         train_dataset = TensorDataset(data[:interval], cond[0][:interval])
         data_val = TensorDataset(data[interval:], cond[0][interval:])
     train_function, val_function = forward_function(paradigm)
+    validation = None
+    if args.val_steps is not None or args.val_subset is not None or args.val_proxy or args.val_background:
+        validation = Validation(args.val_steps, args.val_subset, args.val_proxy, args.val_background)
     if paradigm == "diffusion":
         if model_type == "Unet":
             model = Unet3D_with_Conv3D(
@@ -258,6 +306,11 @@ if __name__ == "__main__":
             save_every=args.checkpoint,
             results_folder=results_folder,
             gradient_accumulate_every=args.gradient_accumulate_every,
+            prefetch=args.prefetch,
+            validation=validation,
+            resume=args.resume,
+            log_every=args.log_every,
+            sync_every=args.sync_every,
         )
 
         train.train()
@@ -297,5 +350,9 @@ if __name__ == "__main__":
             save_every=args.checkpoint,
             results_folder=results_folder,
             gradient_accumulate_every=args.gradient_accumulate_every,
+            prefetch=args.prefetch,
+            resume=args.resume,
+            log_every=args.log_every,
+            sync_every=args.sync_every,
         )
         train.train()
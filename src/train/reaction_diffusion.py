@@ -25,6 +25,7 @@ from src.model.diffusion import GaussianDiffusion
 from src.model.UNet2d import Unet2D
 from src.model.fno import FNO2D
 from src.train.train import Trainer
+from src.train.validation import Validation
 from src.utils.utils import create_res, set_seed, get_time, save_config_from_args, get_parameter_net, find_max_min
 import time
 
@@ -95,6 +96,15 @@ if __name__ == "__main__":
     parser.add_argument("--model_type", default="FNO", type=str, help="Unet or ViT or FNO")
     parser.add_argument("--network_dim", default=2, type=int, help="1 or 2")
     parser.add_argument("--gradient_accumulate_every", default=2, type=int, help="gradient_accumulate_every")
+    parser.add_argument("--resume", action="store_true", help="resume from the latest checkpoint in the folder")
+    parser.add_argument(
+        "--log_every", default=None, type=int, help="steps between throughput and step-time logs (metrics.csv)"
+    )
+    parser.add_argument("--sync_every", default=1, type=int, help="steps between copies of the training loss to host")
+    parser.add_argument("--val_steps", default=None, type=int, help="DDIM steps of validation sampling")
+    parser.add_argument("--val_subset", default=None, type=int, help="validation samples, all by default")
+    parser.add_argument("--val_proxy", action="store_true", help="validate with the denoising loss, no sampling")
+    parser.add_argument("--val_background", action="store_true", help="validate on a background thread")
     # FNO
     parser.add_argument("--fno_nlayer", default=4, type=int, help="fno layers")
     parser.add_argument("--fno_layer_size", default=24, type=int, help="fno_layer_size")
@@ -136,6 +146,9 @@ if __name__ == "__main__":
     train_dataset = TensorDataset(data[:interval], cond[:interval])
     test_dataset = TensorDataset(data[interval:], cond[interval:])
     train_function, val_function = forward_function(paradigm)
+    validation = None
+    if args.val_steps is not None or args.val_subset is not None or args.val_proxy or args.val_background:
+        validation = Validation(args.val_steps, args.val_subset, args.val_proxy, args.val_background)
     if paradigm == "diffusion":
         if model_type == "Unet":
             model = Unet2D(
@@ -174,6 +187,10 @@ if __name__ == "__main__":
             save_every=args.checkpoint,
             results_folder=results_folder,
             gradient_accumulate_every=args.gradient_accumulate_every,
+            validation=validation,
+            resume=args.resume,
+            log_every=args.log_every,
+            sync_every=args.sync_every,
         )
         train.train()
     elif paradigm == "surrogate":
@@ -208,5 +225,8 @@ if __name__ == "__main__":
             train_batch_size=args.batchsize,
             save_every=args.checkpoint,
             results_folder=results_folder,
+            resume=args.resume,
+            log_every=args.log_every,
+            sync_every=args.sync_every,
         )
         train.train()
@@ -0,0 +1,78 @@
+import argparse
+import tempfile
+import time
+import torch
+from torch import nn
+from torch.utils.data import TensorDataset
+import sys, os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from filepath import ABSOLUTE_PATH
+
+sys.path.append(ABSOLUTE_PATH)
+from src.train.train import Trainer
+from src.utils.utils import set_seed
+
+
+def get_loss(model, batch, loss_fn):
+    x, y = batch
+    return loss_fn(model(x), y)
+
+
+def step_time(args, sync_every):
+    """train a small MLP for args.steps steps with Trainer(sync_every=sync_every)
+
+    Returns:
+        float: wall time per step (ms), including one checkpoint at the last step
+    """
+    set_seed(args.seed)
+    x = torch.randn(args.n_data, args.dim)
+    dataset = TensorDataset(x, x.sin())
+    model = nn.Sequential(
+        *[layer for _ in range(args.layer) for layer in (nn.Linear(args.dim, args.dim), nn.GELU())],
+        nn.Linear(args.dim, args.dim),
+    )
+    with tempfile.TemporaryDirectory() as folder:
+        trainer = Trainer(
+            model=model,
+            data_train=dataset,
+            data_val=TensorDataset(x[: args.batch_size], x[: args.batch_size].sin()),
+            train_function=get_loss,
+            val_function=get_loss,
+            train_batch_size=args.batch_size,
+            gradient_accumulate_every=args.accumulate,
+            train_num_steps=args.steps,
+            save_every=args.steps,
+            results_folder=folder,
+            async_save=False,
+            sync_every=sync_every,
+        )
+        if trainer.device.type == "cuda":
+            torch.cuda.synchronize()
+        begin = time.perf_counter()
+        trainer.train()
+        if trainer.device.type == "cuda":
+            torch.cuda.synchronize()
+        return (time.perf_counter() - begin) / args.steps * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="training step time with the loss synchronized every n steps")
+    parser.add_argument("--sync_every", default="1,10,100", type=lambda s: [int(item) for item in s.split(",")])
+    parser.add_argument("--steps", default=500, type=int, help="training steps of each run")
+    parser.add_argument("--repeat", default=3, type=int, help="runs of each sync_every, the fastest is reported")
+    parser.add_argument("--dim", default=64, type=int, help="width of the MLP")
+    parser.add_argument("--layer", default=2, type=int, help="hidden layers of the MLP")
+    parser.add_argument("--batch_size", default=32, type=int, help="batch size")
+    parser.add_argument("--accumulate", default=2, type=int, help="gradient accumulation steps")
+    parser.add_argument("--n_data", default=4096, type=int, help="training samples")
+    parser.add_argument("--seed", default=42, type=int, help="random seed")
+    args = parser.parse_args()
+
+    step_time(args, args.sync_every[0])  # warm up
+    times = {}
+    for sync_every in args.sync_every:
+        times[sync_every] = min(step_time(args, sync_every) for _ in range(args.repeat))
+    for sync_every, ms in times.items():
+        speedup = times[args.sync_every[0]] / ms
+        print(f"sync_every={sync_every}: {ms:.3f} ms/step, speedup: {speedup:.2f}x")
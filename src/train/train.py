@@ -1,11 +1,11 @@
 import math
+from functools import partial
 from pathlib import Path
-import numpy as np
 import torch
 import torch.nn.functional as F
 from torch.cuda.amp import autocast
 from torch.optim import Adam
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, TensorDataset
 
 from accelerate import Accelerator
 from ema_pytorch import EMA
@@ -17,6 +17,17 @@ sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from filepath import ABSOLUTE_PATH
 
 sys.path.append(ABSOLUTE_PATH)
+from src.train.data import TensorBatchLoader, MemmapDataset, Prefetcher
+from src.train.checkpoint import (
+    CheckpointWriter,
+    load_checkpoint,
+    load_record,
+    latest_milestone,
+    rng_state,
+    set_rng_state,
+)
+from src.train.metrics import TrainMetrics, batch_samples
+
 __version__ = "1.0.0"
 
 
@@ -58,12 +69,23 @@ class Trainer(object):
         split_batches=True,
         max_grad_norm=1.0,
         loss_fn=F.mse_loss,
+        prefetch=0,
+        prefetch_threads=2,
+        async_save=True,
+        keep_best=None,
+        safetensors=False,
+        validation=None,
+        resume=False,
+        log_every=None,
+        sync_every=1,
     ):
         super().__init__()
 
         self.loss_fn = loss_fn
         self.train_function = train_function
         self.val_function = val_function
+        # validation policy (Validation) at each checkpoint, None for val_function over all of data_val
+        self.validation = validation
         # accelerator
         self.accelerator = Accelerator(
             split_batches=split_batches, mixed_precision=mixed_precision_type if amp else "no"
@@ -86,21 +108,41 @@ class Trainer(object):
 
         self.train_num_steps = train_num_steps
 
-        # dataset and dataloader
-
-        dl = (
-            DataLoader(data_train, batch_size=train_batch_size, shuffle=True)
-            if not isinstance(data_train, DataLoader)
-            else data_train
-        )
-        self.data_val = (
-            DataLoader(data_val, batch_size=train_batch_size * 10, shuffle=True)
-            if not isinstance(data_val, DataLoader)
-            else data_val
-        )
+        # dataset and dataloader, in-memory tensors and memory-mapped arrays are read batch-wise by TensorBatchLoader
+
+        if isinstance(data_train, (TensorDataset, MemmapDataset)):
+            world_size = self.accelerator.num_processes
+            dl = TensorBatchLoader(
+                data_train,
+                batch_size=train_batch_size * (1 if split_batches else world_size),
+                shuffle=True,
+                rank=self.accelerator.process_index,
+                world_size=world_size,
+                device=self.device if prefetch == 0 else None,
+            )
+        elif not isinstance(data_train, (DataLoader, TensorBatchLoader)):
+            dl = DataLoader(data_train, batch_size=train_batch_size, shuffle=True)
+        else:
+            dl = data_train
+        if isinstance(data_val, (TensorDataset, MemmapDataset)):
+            self.data_val = TensorBatchLoader(data_val, batch_size=train_batch_size * 10, device=self.device)
+        elif not isinstance(data_val, (DataLoader, TensorBatchLoader)):
+            self.data_val = DataLoader(data_val, batch_size=train_batch_size * 10, shuffle=True)
+        else:
+            self.data_val = data_val
         # , pin_memory=True, num_workers=cpu_count())
-        dl = self.accelerator.prepare(dl)
-        self.dl = cycle(dl)
+        if isinstance(dl, DataLoader):
+            dl = self.accelerator.prepare(dl)
+        elif dl.device is None and prefetch == 0:
+            # batches of a TensorBatchLoader on the device of the model, as prepare does for a DataLoader
+            dl.device = self.device
+        if isinstance(self.data_val, TensorBatchLoader) and self.data_val.device is None:
+            self.data_val.device = self.device
+        self.loader = dl
+        self.prefetch, self.prefetch_threads = prefetch, prefetch_threads
+        self.dl = self.batches()
+        # batches drawn from the loader since the first step
+        self.data_position = 0
         # optimizer
 
         self.opt = Adam(model.parameters(), lr=train_lr, betas=adam_betas)
@@ -113,6 +155,15 @@ class Trainer(object):
 
         self.results_folder = Path(results_folder)
         self.results_folder.mkdir(exist_ok=True)
+        # checkpoints written in the background, keep_best of them by validation loss and the latest
+        self.checkpoint = CheckpointWriter(
+            self.results_folder, keep_best=keep_best, safetensors=safetensors, asynchronous=async_save
+        )
+        # throughput and step-time breakdown logged every log_every steps
+        self.metrics = TrainMetrics(self.results_folder, log_every if self.accelerator.is_main_process else None)
+        # the training loss is accumulated on device and copied to host every sync_every steps instead of after every
+        # micro-batch; checkpoint_step and metric logs still copy it, so steps with a save synchronize regardless
+        self.sync_every = sync_every
 
         # step counter state
 
@@ -122,11 +173,23 @@ class Trainer(object):
 
         self.model, self.opt = self.accelerator.prepare(self.model, self.opt)
 
+        # continue from the latest checkpoint in results_folder, if any
+        if resume and latest_milestone(self.results_folder) is not None:
+            self.load(latest_milestone(self.results_folder))
+
     @property
     def device(self):
         return self.accelerator.device
 
-    def save(self, milestone):
+    def batches(self):
+        """endless iterator over the training batches, reading the next prefetch batches on background threads
+        for data not resident on device
+        """
+        if self.prefetch > 0:
+            return Prefetcher(self.loader, self.prefetch, self.prefetch_threads, device=self.device)
+        return cycle(self.loader)
+
+    def save(self, milestone, loss=None):
         if not self.accelerator.is_local_main_process:
             return
 
@@ -137,16 +200,21 @@ class Trainer(object):
             "ema": self.ema.state_dict(),
             "scaler": self.accelerator.scaler.state_dict() if exists(self.accelerator.scaler) else None,
             "version": __version__,
+            # checkpoints are taken after the optimizer step, so the gradient accumulation phase is 0
+            "rng": rng_state(),
+            "data_position": self.data_position,
+            "gradient_accumulate_every": self.gradient_accumulate_every,
+            "record": [list(r) for r in self.record],
         }
 
-        torch.save(data, str(self.results_folder / f"model-{milestone}.pt"))
-        np.save(str(self.results_folder / "record.npy"), np.array(self.record))
+        self.checkpoint.save(milestone, data, loss, self.record)
 
     def load(self, milestone):
         accelerator = self.accelerator
         device = accelerator.device
 
-        data = torch.load(str(self.results_folder / f"model-{milestone}.pt"), map_location=device)
+        self.checkpoint.wait()
+        data = load_checkpoint(self.results_folder / f"model-{milestone}.pt", map_location=device)
 
         model = self.accelerator.unwrap_model(self.model)
         model.load_state_dict(data["model"])
@@ -162,6 +230,59 @@ class Trainer(object):
         if exists(self.accelerator.scaler) and exists(data["scaler"]):
             self.accelerator.scaler.load_state_dict(data["scaler"])
 
+        # checkpoints before resumable state have none of these
+        if "record" in data:
+            self.record = load_record(self.results_folder, milestone, data["record"])
+            self.checkpoint.scores = {int(r[0]): r[2] for r in self.record}
+            self.checkpoint.latest = milestone
+        if "data_position" in data:
+            if data["gradient_accumulate_every"] != self.gradient_accumulate_every:
+                print("gradient_accumulate_every changed, data order differs from the uninterrupted run")
+            self.data_position = data["data_position"]
+            if isinstance(self.loader, TensorBatchLoader):
+                self.loader.set_position(self.data_position)
+            if isinstance(self.dl, Prefetcher):
+                self.dl.close()
+            self.dl = self.batches()
+        if "rng" in data:
+            set_rng_state(data["rng"])
+
+    def validated(self, milestone, loss_val, total_loss):
+        """record the validation loss of a checkpoint, called by the validation policy when it is done"""
+        print("mse in validation data: ", loss_val)
+        if isinstance(self.dl, Prefetcher):
+            print("prefetch: ", self.dl.stats())
+        self.record.append([milestone, total_loss, loss_val])
+        self.checkpoint.score(milestone, loss_val, self.record)
+
+    def checkpoint_step(self, total_loss):
+        """validate the EMA model and save a checkpoint"""
+        total_loss = float(total_loss)
+        self.ema.ema_model.eval()
+        milestone = self.step // self.save_every
+        if self.validation is not None:
+            self.save(milestone)
+            self.validation(
+                milestone,
+                self.ema.ema_model,
+                self.data_val,
+                self.val_function,
+                self.train_function,
+                self.loss_fn,
+                partial(self.validated, total_loss=total_loss),
+            )
+            return
+
+        with torch.no_grad():
+            loss_val = 0
+            for batch in self.data_val:
+                loss_val += self.val_function(self.ema.ema_model, batch, self.loss_fn)
+            print("mse in validation data: ", loss_val / (len(self.data_val)))
+            if isinstance(self.dl, Prefetcher):
+                print("prefetch: ", self.dl.stats())
+        self.record.append([milestone, total_loss, loss_val.item()])
+        self.save(milestone, loss_val.item())
+
     def train(self):
         accelerator = self.accelerator
         device = accelerator.device
@@ -172,43 +293,53 @@ class Trainer(object):
                 self.model.train()
 
                 total_loss = 0.0
+                samples = 0
 
                 for _ in range(self.gradient_accumulate_every):
-                    batch = next(self.dl)
+                    with self.metrics.time("data"):
+                        batch = next(self.dl)
+                    self.data_position += 1
+                    if self.metrics.enabled:
+                        samples += batch_samples(batch)
                     with self.accelerator.autocast():
-                        loss = self.train_function(self.model, batch, self.loss_fn)
-                        loss = loss / self.gradient_accumulate_every
-                        total_loss += loss.item()
+                        with self.metrics.time("forward"):
+                            loss = self.train_function(self.model, batch, self.loss_fn)
+                            loss = loss / self.gradient_accumulate_every
+                            total_loss += loss.detach().float() if self.sync_every > 1 else loss.item()
 
-                    self.accelerator.backward(loss)
+                    with self.metrics.time("backward"):
+                        self.accelerator.backward(loss)
 
-                pbar.set_description(f"loss: {total_loss:.6f}")
+                if self.step % self.sync_every == 0:
+                    pbar.set_description(f"loss: {float(total_loss):.6f}")
 
-                accelerator.wait_for_everyone()
-                accelerator.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
+                with self.metrics.time("optimizer"):
+                    # barriers are only needed between processes
+                    if accelerator.num_processes > 1:
+                        accelerator.wait_for_everyone()
+                    accelerator.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
 
-                self.opt.step()
-                self.opt.zero_grad()
+                    self.opt.step()
+                    self.opt.zero_grad(set_to_none=True)
 
-                accelerator.wait_for_everyone()
+                    if accelerator.num_processes > 1:
+                        accelerator.wait_for_everyone()
 
                 self.step += 1
                 if accelerator.is_main_process:
-                    self.ema.update()
+                    with self.metrics.time("ema"):
+                        self.ema.update()
 
                     if self.step != 0 and self.step % self.save_every == 0:
-                        self.ema.ema_model.eval()
-
-                        with torch.no_grad():
-                            milestone = self.step // self.save_every
-                            loss_val = 0
-                            for batch in self.data_val:
-                                loss_val += self.val_function(self.ema.ema_model, batch, self.loss_fn)
-                            print("mse in validation data: ", loss_val / (len(self.data_val)))
-                        self.record.append([milestone, total_loss, loss_val.item()])
-                        self.save(milestone)
+                        with self.metrics.time("checkpoint"):
+                            self.checkpoint_step(total_loss)
+                    self.metrics.step(self.step, samples * accelerator.num_processes, total_loss)
                 pbar.update(1)
 
+        if self.validation is not None:
+            self.validation.wait()
+        self.checkpoint.wait()
+        self.metrics.close()
         accelerator.print("training complete")
         self.record = torch.tensor(self.record)
         min_index = torch.argmin(self.record[:, 2])
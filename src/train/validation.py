@@ -0,0 +1,125 @@
+import copy
+import threading
+from contextlib import contextmanager, nullcontext
+import torch
+
+
+def model_device(model):
+    return next(model.parameters()).device
+
+
+@contextmanager
+def sampling_steps(model, steps):
+    """sample with DDIM in steps steps within the context (a GaussianDiffusion), nothing if steps is None"""
+    if steps is None or not hasattr(model, "sampling_timesteps"):
+        yield
+        return
+    saved = model.sampling_timesteps, model.is_ddim_sampling
+    model.sampling_timesteps = min(steps, model.num_timesteps)
+    model.is_ddim_sampling = model.sampling_timesteps < model.num_timesteps
+    try:
+        yield
+    finally:
+        model.sampling_timesteps, model.is_ddim_sampling = saved
+
+
+class Validation(object):
+    """validation policy of Trainer at each checkpoint, cheaper than sampling the whole validation set with the full
+    ancestral trajectory on the training thread:
+        sampling_steps: sample with few-step DDIM.
+        subset: validate on the first subset samples of the validation data, cached at the first checkpoint.
+        proxy: denoising loss (train_function) instead of sampling, with timesteps and noise drawn from a fixed seed,
+            the same at every checkpoint.
+        background: sample on a background thread and side cuda stream, on a copy of the EMA weights, while training
+            goes on. The validation loss is recorded when it is done. Its noise comes from a generator of its own
+            seeded with seed, so the RNG stream of training is the same as without validation.
+    """
+
+    def __init__(self, sampling_steps=None, subset=None, proxy=False, background=False, seed=0):
+        """
+        Args:
+            sampling_steps (int, optional): DDIM steps of validation sampling. Defaults to None, i.e. as trained.
+            subset (int, optional): validation samples. Defaults to None, i.e. all.
+            proxy (bool, optional): validate with the denoising loss. Defaults to False.
+            background (bool, optional): validate on a background thread, not with proxy. Defaults to False.
+            seed (int, optional): seed of the proxy and of validation sampling. Defaults to 0.
+        """
+        assert not (proxy and background), "the proxy is cheap and runs on the training thread"
+        self.sampling_steps = sampling_steps
+        self.subset = subset
+        self.proxy = proxy
+        self.background = background
+        self.seed = seed
+        self.cache = None
+        self.thread = None
+        self.error = None
+
+    def batches(self, data_val):
+        if self.subset is None:
+            return data_val
+        if self.cache is None:
+            self.cache, n = [], 0
+            for batch in data_val:
+                batch = [b[: self.subset - n] for b in batch]
+                self.cache.append(batch)
+                n += batch[0].shape[0]
+                if n >= self.subset:
+                    break
+        return self.cache
+
+    def evaluate(self, model, data_val, val_function, train_function, loss_fn):
+        """mean validation loss over the batches"""
+        batches = self.batches(data_val)
+        loss_val = 0.0
+        with torch.no_grad(), sampling_steps(model, self.sampling_steps):
+            for batch in batches:
+                if self.proxy:
+                    loss_val += float(train_function(model, batch, loss_fn))
+                else:
+                    loss_val += float(val_function(model, batch, loss_fn))
+        return loss_val / len(batches)
+
+    def __call__(self, milestone, model, data_val, val_function, train_function, loss_fn, callback):
+        """validate model and call callback(milestone, loss), at once or from the background thread"""
+        if not self.background:
+            devices = [model_device(model)] if model_device(model).type == "cuda" else []
+            with torch.random.fork_rng(devices=devices):
+                torch.manual_seed(self.seed)
+                loss = self.evaluate(model, data_val, val_function, train_function, loss_fn)
+            callback(milestone, loss)
+            return
+        # one validation at a time, the copy of the weights is taken now
+        self.wait()
+        model = copy.deepcopy(model)
+        batches = self.batches(data_val)
+        device = model_device(model)
+        if hasattr(model, "generator"):
+            model.generator = torch.Generator(device).manual_seed(self.seed)
+        # the copy is queued on the current stream, the side stream waits for it
+        copied = None
+        if device.type == "cuda":
+            copied = torch.cuda.Event()
+            copied.record()
+
+        def run():
+            try:
+                if copied is not None:
+                    stream = torch.cuda.Stream(device)
+                    stream.wait_event(copied)
+                with torch.cuda.stream(stream) if copied is not None else nullcontext():
+                    loss = self.evaluate(model, batches, val_function, train_function, loss_fn)
+                callback(milestone, loss)
+            except Exception as error:
+                self.error = error
+
+        self.thread = threading.Thread(target=run, name="validation", daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        """block until the background validation is done, and raise its error"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
@@ -0,0 +1,52 @@
+import threading
+import pytest
+import torch
+from ema_pytorch import EMA
+
+from src.train.checkpoint import CheckpointWriter, load_checkpoint
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+@pytest.mark.parametrize("safetensors", [False, True])
+def test_checkpoint_round_trip(tmp_path, safetensors, asynchronous):
+    model = torch.nn.Linear(3, 2)
+    ema = EMA(model, beta=0.9, update_every=1)
+    ema.update()
+    writer = CheckpointWriter(tmp_path, safetensors=safetensors, asynchronous=asynchronous)
+    writer.save(1, {"step": 1, "model": model.state_dict(), "ema": ema.state_dict()}, loss=0.5, record=[[1, 1.0, 0.5]])
+    writer.wait()
+
+    data = load_checkpoint(tmp_path / "model-1.pt")
+    restored = torch.nn.Linear(3, 2)
+    restored.load_state_dict(data["model"])
+    restored_ema = EMA(restored, beta=0.9, update_every=1)
+    restored_ema.load_state_dict(data["ema"])
+    assert torch.equal(restored.weight, model.weight)
+    assert torch.equal(restored_ema.ema_model.weight, ema.ema_model.weight)
+    assert not any(name.startswith("online_model.") for name in torch.load(tmp_path / "model-1.pt").get("ema", {}))
+
+
+def test_checkpoint_score_error_is_raised(tmp_path):
+    writer = CheckpointWriter(tmp_path / "missing", asynchronous=True)
+    writer.score(1, 0.5, record=[[1, 1.0, 0.5]])
+    with pytest.raises(FileNotFoundError):
+        writer.wait()
+    # raised once
+    writer.wait()
+
+
+def test_checkpoint_scores_from_validation_thread(tmp_path):
+    # synchronous writes on this thread, scores set from a validation thread as they finish
+    writer = CheckpointWriter(tmp_path, keep_best=2, asynchronous=False)
+    scored = []
+    for milestone in range(1, 21):
+        writer.save(milestone, {"step": milestone})
+        thread = threading.Thread(target=writer.score, args=(milestone, milestone % 7 + milestone / 100))
+        thread.start()
+        scored.append(thread)
+    for thread in scored:
+        thread.join()
+    writer.wait()
+    # the 2 best (milestones 7 and 14) and the latest
+    assert sorted(writer.scores) == [7, 14, 20]
+    assert sorted(int(path.stem.split("-")[1]) for path in tmp_path.glob("model-*.pt")) == [7, 14, 20]
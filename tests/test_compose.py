@@ -0,0 +1,477 @@
+import json
+import pytest
+import torch
+from torch import nn
+
+from src.inference.adjacency import CompiledAdjacency
+from src.inference.compose import (
+    Anderson,
+    Snapshot,
+    Telemetry,
+    compose_diffusion_ddim,
+    compose_diffusion_ddim_stream,
+    compose_diffusion_multiE,
+    compose_diffusion_multiE_stream,
+    compose_diffusion_multiE_ddim,
+    compose_diffusion_multiE_ddim_stream,
+    model_predictions_chunked,
+    p_sample_chunked,
+)
+from src.inference.heatpipe import neighbors, boundary_emb_f, update
+from src.model.diffusion import GaussianDiffusion
+
+N_NODE = 8
+
+
+def boundary_emb(b_type):
+    return boundary_emb_f(b_type, n_nods=N_NODE)
+
+
+class Denoiser(nn.Module):
+    def __init__(self):
+        super().__init__()
+        # field (3) and the condition assembled by update: 3 slots * 3 channels and flux
+        self.linear = nn.Linear(3 + 10, 3)
+
+    def forward(self, x, t, cond, x_self_cond=None):
+        coord, condition = cond
+        return torch.tanh(self.linear(torch.concat((x, condition), -1))) + t[:, None, None] / 100
+
+
+class FieldDenoiser(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = nn.Linear(3 + 3, 3)
+
+    def forward(self, x, t, cond, x_self_cond=None):
+        return torch.tanh(self.linear(torch.concat((x, cond), -1))) + t[:, None, None] / 100
+
+
+def coupled_update(i):
+    """condition of field i: the estimate of the other field"""
+
+    def update(alpha, estimate, estimate_before, other_condition, normalize, unnormalize):
+        return estimate[1 - i] * alpha + estimate_before[1 - i] * (1 - alpha)
+
+    return update
+
+
+def diffusion(sampling_timesteps=None, eta=0.0, denoiser=Denoiser):
+    torch.manual_seed(0)
+    return GaussianDiffusion(
+        denoiser(),
+        seq_length=(N_NODE, 3),
+        timesteps=8,
+        sampling_timesteps=sampling_timesteps,
+        ddim_sampling_eta=eta,
+        auto_normalize=False,
+    )
+
+
+def assembly():
+    adj = CompiledAdjacency(neighbors, boundary_emb, device="cpu")
+    generator = torch.Generator().manual_seed(1)
+    coord = torch.rand(len(adj), N_NODE, 2, generator=generator)
+    flux = torch.rand(len(adj), generator=generator) * 2 - 1
+    return adj, [coord, flux]
+
+
+def compose_kwargs(ddim, **kwargs):
+    adj, other_condition = assembly()
+    model = diffusion(sampling_timesteps=4, eta=1.0) if ddim else diffusion()
+    return dict(
+        model=model,
+        shape=(N_NODE, 3),
+        cond_shape=10,
+        update_f=update,
+        adj=adj,
+        boundary_emb=boundary_emb,
+        other_condition=other_condition,
+        device="cpu",
+        **{"num_iter": 2, **kwargs},
+    )
+
+
+def collect(stream):
+    """states yielded by a compose stream and its result"""
+    states = []
+    while True:
+        try:
+            states.append(next(stream))
+        except StopIteration as stop:
+            return states, stop.value
+
+
+def test_model_predictions_chunked():
+    model = diffusion()
+    adj, (coord, flux) = assembly()
+    x = torch.randn(len(adj), N_NODE, 3)
+    cond = (coord, adj.assemble(torch.randn(len(adj), N_NODE, 3), flux))
+    time_cond = torch.full((len(adj),), 5, dtype=torch.long)
+    pred_noise, x_start, *_ = model.model_predictions(x, time_cond, cond, clip_x_start=True)
+    pred_noise_c, x_start_c = model_predictions_chunked(model, x, time_cond, cond, 7, clip_x_start=True)
+    assert torch.allclose(pred_noise, pred_noise_c, atol=1e-6)
+    assert torch.allclose(x_start, x_start_c, atol=1e-6)
+
+    torch.manual_seed(2)
+    x_next, x0 = model.p_sample(x, 5, cond)
+    torch.manual_seed(2)
+    x_next_c, x0_c = p_sample_chunked(model, x, 5, cond, 7)
+    assert torch.allclose(x_next, x_next_c, atol=1e-6)
+    assert torch.allclose(x0, x0_c, atol=1e-6)
+
+
+@pytest.mark.parametrize("compose", [compose_diffusion_multiE, compose_diffusion_multiE_ddim])
+def test_compose_chunked_matches_unchunked(compose):
+    ddim = compose is compose_diffusion_multiE_ddim
+    torch.manual_seed(3)
+    field = compose(**compose_kwargs(ddim))
+    torch.manual_seed(3)
+    field_chunked = compose(**compose_kwargs(ddim, chunk_size=5))
+    assert torch.allclose(field, field_chunked, atol=1e-5)
+
+
+@pytest.mark.parametrize("stream", [compose_diffusion_multiE_stream, compose_diffusion_multiE_ddim_stream])
+def test_compose_resume_matches_uninterrupted(tmp_path, stream):
+    ddim = stream is compose_diffusion_multiE_ddim_stream
+    torch.manual_seed(4)
+    _, expected = collect(stream(**compose_kwargs(ddim, yield_every=1)))
+
+    # interrupted in the second outer iteration, after a snapshot at every step
+    torch.manual_seed(4)
+    interrupted = stream(**compose_kwargs(ddim, yield_every=1, snapshot=Snapshot(tmp_path / "snapshot.pt", every=0)))
+    for state in interrupted:
+        if state.k == 1 and state.step == 2:
+            break
+    interrupted.close()
+
+    torch.manual_seed(5)
+    states, field = collect(
+        stream(**compose_kwargs(ddim, yield_every=1, snapshot=Snapshot(tmp_path / "snapshot.pt"), resume=True))
+    )
+    assert states[0].k == 1 and states[0].step == 3
+    assert torch.equal(field, expected)
+
+
+def test_compose_fields_resume_matches_uninterrupted(tmp_path):
+    def run(seed, **kwargs):
+        torch.manual_seed(seed)
+        return compose_diffusion_ddim_stream(
+            [diffusion(4, 1.0, FieldDenoiser), diffusion(4, 1.0, FieldDenoiser)],
+            [(3, N_NODE, 3), (3, N_NODE, 3)],
+            [coupled_update(0), coupled_update(1)],
+            None,
+            None,
+            num_iter=2,
+            device="cpu",
+            yield_every=1,
+            **kwargs,
+        )
+
+    _, expected = collect(run(6))
+    interrupted = run(6, snapshot=Snapshot(tmp_path / "snapshot.pt", every=0))
+    for state in interrupted:
+        if state.k == 1 and state.step == 1:
+            break
+    interrupted.close()
+    _, fields = collect(run(7, snapshot=Snapshot(tmp_path / "snapshot.pt"), resume=True))
+    for field, field_expected in zip(fields, expected):
+        assert torch.equal(field, field_expected)
+
+
+class Surrogate(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = nn.Linear(3, 3)
+        self.calls = 0
+
+    def forward(self, cond):
+        self.calls += 1
+        return torch.tanh(self.linear(cond))
+
+
+@pytest.mark.parametrize("surrogate_every, calls", [(1, 8), (2, 6), (None, 2)])
+def test_compose_surrogate_field(surrogate_every, calls):
+    surrogate = Surrogate()
+    kwargs = {} if surrogate_every == 1 else {"surrogate_every": surrogate_every}
+    torch.manual_seed(8)
+    fields = compose_diffusion_ddim(
+        [surrogate, diffusion(4, 0.0, FieldDenoiser)],
+        [(3, N_NODE, 3), (3, N_NODE, 3)],
+        [coupled_update(0), coupled_update(1)],
+        None,
+        None,
+        num_iter=2,
+        device="cpu",
+        **kwargs,
+    )
+    # 4 steps in each of the 2 outer iterations: every step by default, steps 0, 2, 3 every 2, the last step with None
+    assert surrogate.calls == calls
+    assert all(torch.isfinite(field).all() for field in fields)
+
+
+class ScenarioDenoiser(Denoiser):
+    """predicts x0, nearly constant in the elements without flux, and counts the elements without flux denoised"""
+
+    def __init__(self, jitter=0.0):
+        super().__init__()
+        self.jitter = jitter
+        self.no_flux = 0
+
+    def forward(self, x, t, cond, x_self_cond=None):
+        no_flux = cond[1][:, :1, -1:] == 0
+        self.no_flux += int(no_flux.sum())
+        x_start = super().forward(x, t, cond)
+        return torch.where(no_flux, 0.5 + self.jitter * x_start, x_start)
+
+
+@pytest.mark.parametrize("stream", [compose_diffusion_multiE_stream, compose_diffusion_multiE_ddim_stream])
+@pytest.mark.parametrize("gauss_seidel", [False, True])
+def test_compose_converged_scenario_stops(stream, gauss_seidel):
+    ddim = stream is compose_diffusion_multiE_ddim_stream
+    kwargs = compose_kwargs(ddim, num_iter=3, tol=1e-6, n_scenario=2, gauss_seidel=gauss_seidel)
+    model = kwargs["model"]
+    model.model, model.objective = ScenarioDenoiser(), "pred_x0"
+    # scenario 0 without flux converges after the second outer iteration, scenario 1 does not
+    coord, flux = kwargs["other_condition"]
+    kwargs["other_condition"] = [coord.repeat(2, 1, 1), torch.concat((torch.zeros_like(flux), flux + 2))]
+    n_element = len(kwargs["adj"])
+
+    torch.manual_seed(9)
+    states, field = collect(stream(**kwargs))
+    assert [state.k for state in states] == [0, 1, 2]
+    n_step = 4 if ddim else 8
+    # scenario 0 is denoised in the first two outer iterations only
+    assert model.model.no_flux == 2 * n_step * n_element
+    assert torch.equal(states[2].estimate[:n_element], states[1].estimate[:n_element])
+    assert not torch.equal(states[2].estimate[n_element:], states[1].estimate[n_element:])
+    assert field.shape == (2, n_element, N_NODE, 3)
+
+
+def test_anderson_linear_fixed_point():
+    def iterations(anderson, n=20, tol=1e-6):
+        # x <- a x + b for two samples, a symmetric with eigenvalues in [0, 0.9]
+        generator = torch.Generator().manual_seed(0)
+        q, _ = torch.linalg.qr(torch.randn(n, n, generator=generator, dtype=torch.float64))
+        a = q @ torch.diag(torch.linspace(0, 0.9, n, dtype=torch.float64)) @ q.T
+        b = torch.randn(2, n, generator=generator, dtype=torch.float64)
+        x = torch.zeros(2, n, dtype=torch.float64)
+        for k in range(1, 1000):
+            g = x @ a.T + b
+            if ((g - x).norm(dim=1) / g.norm(dim=1)).max() < tol:
+                return k
+            x = anderson(x, g) if anderson is not None else g
+        return None
+
+    plain = iterations(None)
+    assert plain == 109
+    assert iterations(Anderson(1)) < plain
+    assert iterations(Anderson(3)) < plain / 3
+
+
+def test_anderson_keeps_frozen_elements():
+    torch.manual_seed(10)
+    init_estimate = torch.randn(64, N_NODE, 3)
+    kwargs = compose_kwargs(
+        True, num_iter=3, restart_t=5, freeze_tol=1e-2, anderson=Anderson(1), init_estimate=init_estimate
+    )
+    model = kwargs["model"]
+    model.model, model.objective = ScenarioDenoiser(jitter=1e-3), "pred_x0"
+    # the elements without flux barely change after the first outer iteration and are frozen after the second
+    coord, flux = kwargs["other_condition"]
+    no_flux = torch.arange(len(flux)) % 2 == 0
+    kwargs["other_condition"] = [coord, torch.where(no_flux, 0.0, flux + 2)]
+
+    states, _ = collect(compose_diffusion_multiE_ddim_stream(**kwargs))
+    assert [state.k for state in states] == [0, 1, 2]
+    assert not torch.equal(states[1].estimate[no_flux], states[0].estimate[no_flux])
+    # Anderson extrapolates the elements still denoised only
+    assert torch.equal(states[2].estimate[no_flux], states[1].estimate[no_flux])
+    assert not torch.equal(states[2].estimate[~no_flux], states[1].estimate[~no_flux])
+
+
+class ConditionDenoiser(Denoiser):
+    """predicts x0 from the condition only, so that the field does not depend on the noise, and counts the rows"""
+
+    def __init__(self):
+        super().__init__()
+        self.rows = 0
+
+    def forward(self, x, t, cond, x_self_cond=None):
+        self.rows += x.shape[0]
+        return super().forward(torch.zeros_like(x), t, cond)
+
+
+@pytest.mark.parametrize("stream", [compose_diffusion_multiE_stream, compose_diffusion_multiE_ddim_stream])
+def test_compose_dedup_matches_without_dedup(stream):
+    ddim = stream is compose_diffusion_multiE_ddim_stream
+
+    def run(n_scenario, dedup):
+        torch.manual_seed(11)
+        init_estimate = torch.randn(64, N_NODE, 3)
+        kwargs = compose_kwargs(ddim, restart_t=5, init_estimate=init_estimate, dedup=dedup)
+        kwargs["model"].model, kwargs["model"].objective = ConditionDenoiser(), "pred_x0"
+        if n_scenario is not None:
+            # identical copies of the assembly
+            kwargs["n_scenario"] = n_scenario
+            kwargs["init_estimate"] = init_estimate.repeat(n_scenario, 1, 1)
+            coord, flux = kwargs["other_condition"]
+            kwargs["other_condition"] = [coord.repeat(n_scenario, 1, 1), flux.repeat(n_scenario)]
+        _, field = collect(stream(**kwargs))
+        return field, kwargs["model"].model.rows
+
+    field, rows = run(None, False)
+    field_dedup, rows_dedup = run(2, True)
+    # the copies are denoised once
+    assert rows_dedup == rows
+    for copy in field_dedup:
+        assert torch.allclose(copy, field, atol=1e-6)
+
+
+class ContractiveDenoiser(nn.Module):
+    """predicts x0 as a contraction of the condition, so that the outer iteration converges, and records the batches"""
+
+    def __init__(self):
+        super().__init__()
+        self.linear = nn.Linear(10, 3)
+        self.batches = []
+        self.times = []
+
+    def forward(self, x, t, cond, x_self_cond=None):
+        self.batches.append(x.shape[0])
+        self.times.append(int(t[0]))
+        return 0.5 * torch.tanh(self.linear(cond[1]))
+
+
+def test_gauss_seidel_sweeps_colour_classes():
+    adj, _ = assembly()
+    classes = adj.color_classes()
+    assert torch.equal(torch.sort(torch.concat(classes)).values, torch.arange(len(adj)))
+    for elements in classes:
+        neighbor = adj.neighbor_index[elements][~adj.boundary_mask[elements]]
+        assert not torch.isin(neighbor, elements).any()
+
+    def outer_iterations(gauss_seidel):
+        kwargs = compose_kwargs(True, num_iter=20, tol=1e-4, restart_t=3, gauss_seidel=gauss_seidel)
+        kwargs["model"].model, kwargs["model"].objective = ContractiveDenoiser(), "pred_x0"
+        torch.manual_seed(12)
+        states, _ = collect(compose_diffusion_multiE_ddim_stream(**kwargs))
+        return len(states), kwargs["model"].model.batches
+
+    n_jacobi, batches = outer_iterations(False)
+    assert set(batches) == {len(adj)}
+    n_gauss_seidel, batches = outer_iterations(True)
+    # one batch per colour class in each step
+    assert batches[: len(classes)] == [len(elements) for elements in classes]
+    assert n_gauss_seidel < n_jacobi
+
+
+def test_freeze_shrinks_batch_and_stops():
+    kwargs = compose_kwargs(True, num_iter=50, restart_t=3, freeze_tol=1e-3)
+    kwargs["model"].model, kwargs["model"].objective = ContractiveDenoiser(), "pred_x0"
+    torch.manual_seed(13)
+    states, field = collect(compose_diffusion_multiE_ddim_stream(**kwargs))
+    batches = kwargs["model"].model.batches
+    # frozen elements leave the batch for good, and the composition stops once every element is frozen
+    assert batches[0] == len(kwargs["adj"]) and min(batches) < batches[0]
+    assert all(b_next <= b for b, b_next in zip(batches, batches[1:]))
+    assert len(states) < 50
+    assert field.shape == (len(kwargs["adj"]), N_NODE, 3)
+
+
+class CountingFieldDenoiser(FieldDenoiser):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def forward(self, x, t, cond, x_self_cond=None):
+        self.calls += 1
+        return super().forward(x, t, cond)
+
+
+def test_compose_update_every():
+    def run(update_every):
+        models = [diffusion(4, 0.0, CountingFieldDenoiser), diffusion(4, 0.0, CountingFieldDenoiser)]
+        torch.manual_seed(14)
+        fields = compose_diffusion_ddim(
+            models,
+            [(3, N_NODE, 3), (3, N_NODE, 3)],
+            [coupled_update(0), coupled_update(1)],
+            None,
+            None,
+            num_iter=2,
+            device="cpu",
+            update_every=update_every,
+        )
+        return fields, [model.model.calls for model in models]
+
+    fields, calls = run(None)
+    assert calls == [8, 8]
+    fields_every, calls = run([1, 1])
+    assert calls == [8, 8]
+    assert all(torch.equal(field, field_every) for field, field_every in zip(fields, fields_every))
+    # 4 steps in each of the 2 outer iterations: field 1 at steps 0, 2 and the last
+    fields, calls = run([1, 2])
+    assert calls == [8, 6]
+    assert all(torch.isfinite(field).all() for field in fields)
+
+
+@pytest.mark.parametrize(
+    "stream, times",
+    [
+        (compose_diffusion_multiE_stream, [7, 6, 5, 4, 3, 2, 1, 0] + [3, 2, 1, 0] * 2),
+        (compose_diffusion_multiE_ddim_stream, [7, 5, 3, 1] + [3, 1] * 2),
+    ],
+)
+def test_compose_restart_steps(stream, times):
+    kwargs = compose_kwargs(stream is compose_diffusion_multiE_ddim_stream, num_iter=3, restart_t=3)
+    kwargs["model"].model, kwargs["model"].objective = ContractiveDenoiser(), "pred_x0"
+    torch.manual_seed(15)
+    states, _ = collect(stream(**kwargs))
+    assert len(states) == 3
+    # outer iterations k > 0 denoise from timestep restart_t instead of T
+    assert kwargs["model"].model.times == times
+
+
+@pytest.mark.parametrize(
+    "stream, schedule",
+    [
+        (compose_diffusion_multiE_stream, [3, 6, None]),
+        # the last DDIM step gives the sample, its estimate is that of the outer iteration
+        (compose_diffusion_multiE_ddim_stream, [1, 2, 3, None]),
+    ],
+)
+def test_compose_yield_schedule(stream, schedule):
+    ddim = stream is compose_diffusion_multiE_ddim_stream
+    torch.manual_seed(16)
+    states, field = collect(stream(**compose_kwargs(ddim, yield_every=1 if ddim else 3)))
+    assert [(state.k, state.step) for state in states] == [(k, step) for k in range(2) for step in schedule]
+    assert all(state.estimate.shape == (64, N_NODE, 3) and state.index is None for state in states)
+    # the stream gives the result of the function composing at once
+    torch.manual_seed(16)
+    compose = compose_diffusion_multiE_ddim if ddim else compose_diffusion_multiE
+    assert torch.equal(compose(**compose_kwargs(ddim)), field)
+
+
+def test_telemetry_export(tmp_path):
+    telemetry = Telemetry()
+    torch.manual_seed(17)
+    collect(compose_diffusion_multiE_ddim_stream(**compose_kwargs(True, gauss_seidel=True, telemetry=telemetry)))
+    n_class = len(assembly()[0].color_classes())
+    # 4 steps in each of the 2 outer iterations, one condition and one denoiser span per colour class
+    assert {key: value["count"] for key, value in telemetry.summary().items()} == {
+        "condition": 8 * n_class,
+        "denoise": 8 * n_class,
+    }
+    assert [it["k"] for it in telemetry.iterations] == [0, 1]
+    assert len(telemetry.iterations[1]["change"][0]) == 64
+
+    telemetry.save_json(tmp_path / "telemetry.json")
+    saved = json.loads((tmp_path / "telemetry.json").read_text())
+    assert saved["summary"] == telemetry.summary() and len(saved["spans"]) == 16 * n_class
+    telemetry.save_chrome_trace(tmp_path / "trace.json")
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert len([e for e in events if e["ph"] == "X"]) == 2 + 16 * n_class
+    assert len([e for e in events if e["ph"] == "C"]) == 2
+    assert {e["tid"] for e in events if e.get("cat") == "step"} == set(range(1, n_class + 1))
+    assert all(e["dur"] >= 0 for e in events if e["ph"] == "X")
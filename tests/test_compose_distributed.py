@@ -0,0 +1,67 @@
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch import nn
+
+from src.inference.adjacency import CompiledAdjacency
+from src.inference.compose_distributed import HaloPlan, compose_diffusion_multiE_ddim_distributed, run_distributed
+from src.inference.heatpipe import neighbors, boundary_emb_f, tile_assembly, update
+from src.model.diffusion import GaussianDiffusion
+
+N_NODE = 8
+
+
+def boundary_emb(b_type):
+    return boundary_emb_f(b_type, n_nods=N_NODE)
+
+
+class Denoiser(nn.Module):
+    def __init__(self):
+        super().__init__()
+        # field (3) and the condition assembled by update: 3 slots * 3 channels and flux
+        self.linear = nn.Linear(3 + 10, 3)
+
+    def forward(self, x, t, cond, x_self_cond=None):
+        coord, condition = cond
+        return self.linear(torch.concat((x, condition), -1))
+
+
+def test_halo_plan_local_field():
+    adj = CompiledAdjacency(tile_assembly(neighbors, 2), boundary_emb, device="cpu")
+    n_element, world_size = len(adj), 3
+    field = torch.rand(n_element, N_NODE, 3)
+    plans = [HaloPlan(adj, rank, world_size) for rank in range(world_size)]
+    for rank, plan in enumerate(plans):
+        owned = torch.arange(n_element)[plan.owned]
+        assert torch.equal(plan.elements[: plan.n_owned], owned)
+        assert len(plan.elements) < n_element
+        # the local adjacency gathers from the local field what the global one gathers from the whole field
+        local_adj = adj.restrict(owned, plan.elements)
+        assert torch.equal(local_adj.gather(field[plan.elements]), adj.subset(owned).gather(field))
+        # what a rank sends is what its peer receives
+        for q, index in plan.send.items():
+            assert torch.equal(plan.elements[index], plans[q].elements[plans[q].recv[rank]])
+
+
+def compose_worker(rank, world_size, queue):
+    torch.manual_seed(0)
+    diffusion = GaussianDiffusion(
+        Denoiser(), seq_length=(N_NODE, 3), timesteps=10, sampling_timesteps=4, auto_normalize=False
+    )
+    adj = CompiledAdjacency(tile_assembly(neighbors, 2), boundary_emb, device="cpu")
+    coord, flux = torch.rand(len(adj), N_NODE, 2), torch.rand(len(adj))
+    torch.manual_seed(rank)
+    field = compose_diffusion_multiE_ddim_distributed(
+        diffusion, (N_NODE, 3), 10, update, adj, boundary_emb, other_condition=[coord, flux], num_iter=2
+    )
+    # numpy, tensors are shared through file descriptors that close with the process
+    queue.put((rank, field.numpy()))
+
+
+def test_compose_distributed_two_ranks():
+    queue = mp.get_context("spawn").SimpleQueue()
+    run_distributed(2, compose_worker, queue, port=29611)
+    fields = dict(queue.get() for _ in range(2))
+    assert fields[0].shape == (128, N_NODE, 3)
+    assert np.isfinite(fields[0]).all()
+    assert np.array_equal(fields[0], fields[1])
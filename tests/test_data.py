@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
+
+from src.train.data import MemmapArray, MemmapDataset, TensorBatchLoader, Prefetcher
+
+
+class CountRows(object):
+    """transform counting the rows it is given"""
+
+    def __init__(self):
+        self.rows = 0
+
+    def __call__(self, rows):
+        self.rows += rows.shape[0]
+        return rows * 2
+
+
+def test_memmap_array_reads_sampled_rows(tmp_path):
+    data = np.random.rand(1000, 3).astype(np.float32)
+    np.save(tmp_path / "data.npy", data)
+    transform = CountRows()
+    array = MemmapArray(str(tmp_path / "data.npy"), transform).subset(100)
+    index = torch.tensor([7, 500, 7, 3])
+    assert torch.equal(array[index], torch.from_numpy(data[100 + index.numpy()]) * 2)
+    # the duplicate row is read and transformed once
+    assert transform.rows == 3
+
+
+def test_memmap_array_concurrent_reads(tmp_path):
+    data = np.random.rand(64, 3).astype(np.float32)
+    np.save(tmp_path / "data.npy", data)
+    array = MemmapArray(str(tmp_path / "data.npy"))
+
+    def read(seed):
+        generator = torch.Generator().manual_seed(seed)
+        for _ in range(100):
+            index = torch.randint(0, len(array), (4,), generator=generator)
+            assert torch.equal(array[index], torch.from_numpy(data[index.numpy()]))
+        return True
+
+    with ThreadPoolExecutor(8) as pool:
+        assert all(pool.map(read, range(8)))
+
+
+def test_prefetcher_memmap_dataset(tmp_path):
+    data = np.random.rand(64, 2).astype(np.float32)
+    np.save(tmp_path / "data.npy", data)
+    loader = TensorBatchLoader(MemmapDataset(MemmapArray(str(tmp_path / "data.npy"))), batch_size=8)
+    prefetcher = Prefetcher(loader, depth=4, n_thread=4)
+    batches = [next(prefetcher)[0] for _ in range(len(loader))]
+    prefetcher.close()
+    assert torch.equal(torch.cat(batches), torch.from_numpy(data))
+
+
+def test_tensor_batch_loader_device():
+    dataset = TensorDataset(torch.rand(10, 2), torch.rand(10))
+    # meta stands in for an accelerator device here
+    for batch in TensorBatchLoader(dataset, batch_size=4, shuffle=True, device="meta"):
+        assert all(b.device.type == "meta" for b in batch)
+    loader = TensorBatchLoader(dataset, batch_size=4)
+    assert all(b.device.type == "cpu" for b in next(iter(loader)))
+    assert next(iter(loader))[0].shape == (4, 2)
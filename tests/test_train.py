@@ -0,0 +1,86 @@
+import pytest
+import torch
+from torch import nn
+from torch.utils.data import TensorDataset
+from torch_geometric.data import Data
+from torch_geometric.loader import DataLoader as DataLoader_G
+from torch_geometric.nn import GIN
+
+from src.train.metrics import batch_samples
+from src.train.train import Trainer
+from src.train.validation import Validation
+
+
+def graph_loss(model, batch, loss_fn):
+    return loss_fn(model(x=batch.x, edge_index=batch.edge_index, batch=batch.batch), batch.y)
+
+
+def mlp_loss(model, batch, loss_fn):
+    x, y = batch
+    return loss_fn(model(x), y)
+
+
+def graphs(n):
+    edge_index = torch.tensor([[0, 1, 1, 2], [1, 0, 2, 1]])
+    return [Data(x=torch.rand(3, 4), y=torch.rand(3, 2), edge_index=edge_index) for _ in range(n)]
+
+
+def test_batch_samples():
+    assert batch_samples(next(iter(DataLoader_G(graphs(5), batch_size=4)))) == 4
+    assert batch_samples([torch.zeros(3, 2), torch.zeros(3)]) == 3
+    assert batch_samples(torch.zeros(6, 1)) == 6
+
+
+def test_trainer_step_on_graph_batches(tmp_path):
+    model = GIN(in_channels=4, hidden_channels=8, out_channels=2, num_layers=2)
+    trainer = Trainer(
+        model=model,
+        data_train=DataLoader_G(graphs(8), batch_size=4, shuffle=True),
+        data_val=DataLoader_G(graphs(4), batch_size=4),
+        train_function=graph_loss,
+        val_function=graph_loss,
+        train_batch_size=4,
+        gradient_accumulate_every=2,
+        train_num_steps=1,
+        save_every=1,
+        results_folder=tmp_path,
+        async_save=False,
+        log_every=1,
+    )
+    trainer.train()
+    assert trainer.step == 1
+    assert (tmp_path / "model-1.pt").exists()
+    assert (tmp_path / "metrics.csv").read_text().splitlines()[1].split(",")[1] != "0.0"
+
+
+def mlp_trainer(folder, train_num_steps, **kwargs):
+    torch.manual_seed(0)
+    x = torch.rand(64, 4)
+    return Trainer(
+        model=nn.Sequential(nn.Linear(4, 8), nn.GELU(), nn.Linear(8, 4)),
+        data_train=TensorDataset(x, x.sin()),
+        data_val=TensorDataset(x[:8], x[:8].sin()),
+        train_function=mlp_loss,
+        val_function=mlp_loss,
+        train_batch_size=8,
+        gradient_accumulate_every=2,
+        train_num_steps=train_num_steps,
+        save_every=2,
+        results_folder=folder,
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("validation", [None, Validation()])
+def test_trainer_resume_matches_uninterrupted(tmp_path, validation):
+    expected = mlp_trainer(tmp_path / "uninterrupted", 6, validation=validation)
+    expected.train()
+
+    mlp_trainer(tmp_path / "resumed", 4, validation=validation).train()
+    resumed = mlp_trainer(tmp_path / "resumed", 6, validation=validation, resume=True)
+    assert resumed.step == 4
+    assert [r[0] for r in resumed.record] == [1, 2]
+    resumed.train()
+    for p, p_expected in zip(resumed.model.parameters(), expected.model.parameters()):
+        assert torch.equal(p, p_expected)
+    assert torch.equal(resumed.record, expected.record)
@@ -0,0 +1,90 @@
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from src.model.diffusion import GaussianDiffusion
+from src.train.validation import Validation
+
+
+class Denoiser(nn.Module):
+    def __init__(self, channels=2):
+        super().__init__()
+        self.conv = nn.Conv1d(channels * 2, channels, 3, padding=1)
+
+    def forward(self, x, t, cond, x_self_cond=None):
+        return self.conv(torch.cat((x, cond[0]), 1)) + t[:, None, None] / 10
+
+
+def sample_loss(model, batch, loss_fn=F.mse_loss):
+    data, *cond = batch
+    return loss_fn(data, model.sample(data.shape[0], cond))
+
+
+def test_background_validation_keeps_training_rng():
+    torch.manual_seed(0)
+    diffusion = GaussianDiffusion(Denoiser(), seq_length=(2, 8), timesteps=10, auto_normalize=False)
+    data_val = [(torch.rand(4, 2, 8), torch.rand(4, 2, 8))]
+    losses = []
+    validation = Validation(background=True, seed=3)
+    for milestone in range(2):
+        state = torch.get_rng_state()
+        validation(milestone, diffusion, data_val, sample_loss, None, F.mse_loss, lambda m, loss: losses.append(loss))
+        validation.wait()
+        assert torch.equal(torch.get_rng_state(), state)
+        torch.rand(1)
+    # the same noise at every checkpoint
+    assert len(losses) == 2 and losses[0] == losses[1]
+    assert diffusion.generator is None
+
+
+def denoise_loss(model, batch, loss_fn=F.mse_loss):
+    data, *cond = batch
+    return model(data, cond)
+
+
+def test_proxy_validation_fixed_noise():
+    torch.manual_seed(0)
+    diffusion = GaussianDiffusion(Denoiser(), seq_length=(2, 8), timesteps=10, auto_normalize=False)
+    data_val = [(torch.rand(4, 2, 8), torch.rand(4, 2, 8))] * 2
+    losses = []
+    validation = Validation(proxy=True, seed=3)
+    for milestone in range(2):
+        state = torch.get_rng_state()
+        validation(milestone, diffusion, data_val, None, denoise_loss, F.mse_loss, lambda m, loss: losses.append(loss))
+        assert torch.equal(torch.get_rng_state(), state)
+        torch.rand(1)
+    # the same timesteps and noise at every checkpoint
+    assert len(losses) == 2 and losses[0] == losses[1]
+    torch.manual_seed(3)
+    assert losses[0] == (float(denoise_loss(diffusion, data_val[0])) + float(denoise_loss(diffusion, data_val[1]))) / 2
+
+
+class Batches(object):
+    """validation data counting the batches read"""
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.read = 0
+
+    def __iter__(self):
+        for batch in self.batches:
+            self.read += 1
+            yield batch
+
+
+def test_subset_validation_cached():
+    data = torch.arange(20.0).reshape(10, 2)
+    data_val = Batches([(data[i : i + 4], data[i : i + 4] * 2) for i in range(0, 10, 4)])
+    rows = []
+
+    def val_function(model, batch, loss_fn):
+        rows.append(batch[0].shape[0])
+        return loss_fn(batch[0] * 2, batch[1])
+
+    validation = Validation(subset=6)
+    losses = []
+    for milestone in range(2):
+        validation(milestone, nn.Linear(2, 2), data_val, val_function, None, F.mse_loss, lambda m, l: losses.append(l))
+    # the first 6 samples, read from data_val once
+    assert rows == [4, 2, 4, 2] and data_val.read == 2
+    assert losses == [0.0, 0.0]